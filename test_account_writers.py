@@ -0,0 +1,77 @@
+import json
+import os
+
+from vk_harvester import JsonAccountWriter, JsonlAccountWriter
+
+
+def read_lines(filename):
+    with open(filename, 'r', encoding='utf-8') as fIn:
+        return [json.loads(line) for line in fIn]
+
+
+def write_account(filename, post_ids, append=False, complete=True):
+    writer = JsonlAccountWriter(filename, append=append)
+    for postId in post_ids:
+        writer.write_post(postId, {'text': 'post ' + str(postId)})
+    writer.close({'id': 1}, complete=complete)
+
+
+def test_new_download_replaces_file_when_complete(tmp_path):
+    filename = str(tmp_path / 'club1.jsonl')
+    write_account(filename, [1, 2])
+    write_account(filename, [3])
+    assert [record.get('id') for record in read_lines(filename)] == [3, None]
+    assert not os.path.exists(filename + '.part')
+
+
+def test_failed_download_keeps_earlier_file(tmp_path):
+    filename = str(tmp_path / 'club1.jsonl')
+    write_account(filename, [1, 2])
+    write_account(filename, [3], complete=False)
+    assert [record.get('id') for record in read_lines(filename)] == [1, 2, None]
+    assert JsonlAccountWriter.is_complete(filename)
+    assert [record['id'] for record in read_lines(filename + '.part')] == [3]
+
+
+def test_failed_update_is_removed(tmp_path):
+    filename = str(tmp_path / 'club1.jsonl')
+    write_account(filename, [1, 2])
+    write_account(filename, [3, 4], append=True, complete=False)
+    assert [record.get('id') for record in read_lines(filename)] == [1, 2, None]
+    write_account(filename, [3], append=True)
+    assert [record.get('id') for record in read_lines(filename)] == [1, 2, None, 3, None]
+
+
+def test_recover_after_crash(tmp_path):
+    filename = str(tmp_path / 'club1.jsonl')
+    write_account(filename, [1, 2])
+    writer = JsonlAccountWriter(filename, append=True)
+    writer.write_post(3, {'text': 'post 3'})
+    writer.fOut.write('{"id": 4, "te')
+    writer.fOut.close()
+    assert not JsonlAccountWriter.is_complete(filename)
+    assert JsonlAccountWriter.recover(filename)
+    assert JsonlAccountWriter.is_complete(filename)
+    assert [record.get('id') for record in read_lines(filename)] == [1, 2, None]
+    assert not JsonlAccountWriter.recover(filename)
+
+
+def test_recover_without_meta(tmp_path):
+    filename = str(tmp_path / 'club1.jsonl')
+    with open(filename, 'w', encoding='utf-8') as fOut:
+        fOut.write('{"id": 1, "text": "post 1", "type": "post"}\n')
+    assert not JsonlAccountWriter.recover(filename)
+    assert os.path.getsize(filename) > 0
+    assert not JsonlAccountWriter.recover(str(tmp_path / 'club2.jsonl'))
+
+
+def test_json_writer_keeps_earlier_file(tmp_path):
+    filename = str(tmp_path / 'club1.json')
+    writer = JsonAccountWriter(filename)
+    writer.write_post(1, {'text': 'post 1'})
+    writer.close({'id': 1})
+    writer = JsonAccountWriter(filename, append=True)
+    writer.write_post(2, {'text': 'post 2'})
+    writer.close({'id': 1}, complete=False)
+    with open(filename, 'r', encoding='utf-8') as fIn:
+        assert list(json.load(fIn)['posts']) == ['1']
@@ -0,0 +1,163 @@
+import re
+import threading
+
+import pytest
+
+from vk_harvester import VkHarvester
+
+
+class ScriptedApi:
+    """
+    Stand-in for VkHarvester.get_response: answers wall.get with the number
+    of posts, and execute requests with posts() or comments().
+    """
+    def __init__(self, n_posts=10):
+        self.n_posts = n_posts
+
+    def __call__(self, url, params):
+        if url.endswith('wall.get'):
+            return {'response': {'count': self.n_posts, 'items': []}}
+        if 'API.wall.getComments' in params['code']:
+            return self.comments(params['code'])
+        return self.posts(params['code'])
+
+    def posts(self, code):
+        raise RuntimeError('Connection reset')
+
+    def comments(self, code):
+        return None
+
+
+class FailingComments(ScriptedApi):
+    """
+    A wall where all posts can be downloaded, but none of their comments.
+    """
+    def posts(self, code):
+        return {'response': [{'id': i, 'date': 1500000000, 'text': 'post', 'from_id': -1,
+                              'comments': {'count': 150 if i == 1 else 5}}
+                             for i in range(1, self.n_posts + 1)]}
+
+
+class FailingInBatch(ScriptedApi):
+    """
+    A wall where each post has one comment, and the first call of each
+    batched comment script fails (returns false).
+    """
+    def __init__(self, n_posts=10):
+        ScriptedApi.__init__(self, n_posts)
+        self.nSingleRequests = 0
+
+    def posts(self, code):
+        return {'response': [{'id': i, 'date': 1500000000, 'text': 'post', 'from_id': -1,
+                              'comments': {'count': 1}}
+                             for i in range(1, self.n_posts + 1)]}
+
+    def comments(self, code):
+        comment = {'id': 1, 'date': 1500000000, 'text': 'comment', 'from_id': -1}
+        if code.startswith('return ['):
+            nCalls = code.count('API.wall.getComments')
+            return {'response': [False] + [[comment]] * (nCalls - 1)}
+        self.nSingleRequests += 1
+        return {'response': [comment]}
+
+
+class Wall(ScriptedApi):
+    """
+    A wall of n_posts posts without comments; the post IDs go from n_posts
+    (the newest one) down to 1. The pages requested are recorded as
+    (offset, number of posts) tuples.
+    """
+    def __init__(self, n_posts=10):
+        ScriptedApi.__init__(self, n_posts)
+        self.pages = []
+
+    def posts(self, code):
+        nMax, offset = (int(n) for n in re.search('offset < ([0-9]+) && \\(offset \\+ ([0-9]+)\\)', code).groups())
+        self.pages.append((offset, nMax))
+        return {'response': [{'id': self.n_posts - i, 'date': 1500000000, 'text': 'post', 'from_id': -1}
+                             for i in range(offset, min(offset + nMax, self.n_posts))]}
+
+
+class SparseProjection(ScriptedApi):
+    """
+    A wall where only the second post is a repost, and items@.field leaves
+    out the posts that lack the field instead of returning null for them.
+    """
+    def posts(self, code):
+        posts = [{'id': i, 'date': 1500000000, 'text': 'post', 'from_id': -1}
+                 for i in range(self.n_posts, 0, -1)]
+        posts[1]['copy_history'] = [{'id': 5, 'owner_id': -2, 'text': 'reposted'}]
+        if 'items@.' not in code:
+            return {'response': posts}
+        columns = {}
+        for field in re.findall('items@\\.([a-z_]+)', code):
+            columns[field] = [ps[field] for ps in posts if field in ps]
+        return {'response': columns}
+
+
+@pytest.fixture
+def harvester(tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    (tmp_path / 'xx_vk_urls.txt').write_text('', encoding='utf-8')
+    vkHarvester = VkHarvester('xx')
+    vkHarvester.pipeline = True
+    return vkHarvester
+
+
+def make_account_dict(harvester=None):
+    writer = None
+    if harvester is not None:
+        writer = harvester.writer_class('club1.json')
+    return {'meta': {'id': 1, 'screen_name': 'club1'}, 'posts': {}, 'writer': writer, 'state': {}}
+
+
+def test_pipeline_is_closed_when_paging_fails(harvester, monkeypatch):
+    monkeypatch.setattr(harvester, 'get_response', ScriptedApi())
+    nThreads = threading.active_count()
+    with pytest.raises(RuntimeError):
+        harvester.get_posts(make_account_dict(), is_group=True)
+    assert harvester.pipelines == []
+    assert threading.active_count() == nThreads
+
+
+@pytest.mark.parametrize('pipeline', [False, True])
+def test_failed_comments_fail_the_account(harvester, monkeypatch, pipeline):
+    harvester.pipeline = pipeline
+    monkeypatch.setattr(harvester, 'get_response', FailingComments(n_posts=3))
+    accountDict = make_account_dict(harvester)
+    assert not harvester.get_posts(accountDict, is_group=True)
+    assert harvester.stats.snapshot()['counters']['posts'] == 3
+
+
+@pytest.mark.parametrize('pipeline', [False, True])
+def test_failed_call_in_batch_is_retried(harvester, monkeypatch, pipeline):
+    harvester.pipeline = pipeline
+    harvester.comment_fields = None
+    api = FailingInBatch(n_posts=3)
+    monkeypatch.setattr(harvester, 'get_response', api)
+    assert harvester.get_posts(make_account_dict(harvester), is_group=True)
+    assert harvester.stats.snapshot()['counters']['comments'] == 3
+    assert api.nSingleRequests == 1
+
+
+def test_incremental_harvest_starts_with_small_page(harvester, monkeypatch):
+    harvester.pipeline = False
+    harvester.post_fields = None
+    api = Wall(n_posts=3005)
+    monkeypatch.setattr(harvester, 'get_response', api)
+    accountDict = make_account_dict(harvester)
+    accountDict['state'] = {'newest_id': 3000, 'comment_counts': {str(i): 0 for i in range(1, 3001)}}
+    assert harvester.get_posts(accountDict, is_group=True)
+    assert api.pages[0] == (0, 200)
+    assert sum(nMax for offset, nMax in api.pages) < 1000
+    assert harvester.stats.snapshot()['counters']['posts'] == 5
+
+
+def test_posts_are_downloaded_without_projection_if_columns_differ(harvester, monkeypatch):
+    harvester.pipeline = False
+    monkeypatch.setattr(harvester, 'get_response', SparseProjection(n_posts=3))
+    accountDict = make_account_dict(harvester)
+    assert harvester.get_posts(accountDict, is_group=True)
+    posts = accountDict['writer'].posts
+    assert sorted(posts) == [1, 2, 3]
+    assert posts[2]['copy_text'] == 'reposted'
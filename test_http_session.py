@@ -0,0 +1,191 @@
+import gzip
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import parse
+
+import pytest
+
+from vk_harvester import HttpError, HttpSession, VkHarvester
+
+
+class ScriptedHandler(BaseHTTPRequestHandler):
+    """
+    Answer each request with the next reply from server.script, a list of
+    (HTTP status, body) tuples, and {"response": 1} when it is empty.
+    A body that is not bytes is sent as JSON. Every request is logged
+    in server.log as a dictionary.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        urlParts = parse.urlsplit(self.path)
+        self.reply('GET', urlParts.path, dict(parse.parse_qsl(urlParts.query)))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.reply('POST', self.path, dict(parse.parse_qsl(body.decode('utf-8'))))
+
+    def reply(self, method, path, params):
+        self.server.log.append({'method': method, 'path': path, 'params': params,
+                                'client_port': self.client_address[1]})
+        status, body = 200, {'response': 1}
+        if len(self.server.script) > 0:
+            status, body = self.server.script.pop(0)
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            if self.server.truncate_gzip > 0:
+                self.server.truncate_gzip -= 1
+                body = gzip.compress(body)[:-10]
+            else:
+                body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    httpServer = ThreadingHTTPServer(('127.0.0.1', 0), ScriptedHandler)
+    httpServer.script = []
+    httpServer.log = []
+    httpServer.truncate_gzip = 0
+    httpServer.url = 'http://127.0.0.1:' + str(httpServer.server_port) + '/method/'
+    thread = threading.Thread(target=httpServer.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    thread.start()
+    yield httpServer
+    httpServer.shutdown()
+    httpServer.server_close()
+
+
+@pytest.fixture
+def harvester(server, tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    (tmp_path / 'config.txt').write_text('token 1000\n', encoding='utf-8')
+    (tmp_path / 'xx_vk_urls.txt').write_text('', encoding='utf-8')
+    vkHarvester = VkHarvester('xx')
+    vkHarvester.api_url = server.url
+    vkHarvester.max_retries = 3
+    vkHarvester.retry_delay = 0.0
+    yield vkHarvester
+    for session in vkHarvester.http_sessions.values():
+        session.close()
+
+
+def test_keep_alive_connection_is_reused(server):
+    session = HttpSession(timeout=5)
+    for i in range(3):
+        body, nWireBytes = session.request(server.url + 'users.get', {'n': i})
+        assert json.loads(body.decode('utf-8')) == {'response': 1}
+    session.close()
+    assert len(server.log) == 3
+    assert len(set(entry['client_port'] for entry in server.log)) == 1
+
+
+def test_gzip_body_is_decoded(server):
+    server.script.append((200, {'response': [{'id': 1, 'text': 'тест'}]}))
+    session = HttpSession(timeout=5)
+    body, nWireBytes = session.request(server.url + 'wall.get', {})
+    session.close()
+    assert json.loads(body.decode('utf-8')) == {'response': [{'id': 1, 'text': 'тест'}]}
+    assert nWireBytes == len(gzip.compress(body))
+
+
+def test_long_query_is_sent_as_post(server):
+    session = HttpSession(timeout=5, max_get_length=100)
+    session.request(server.url + 'execute', {'code': 'x' * 50})
+    session.request(server.url + 'execute', {'code': 'x' * 200})
+    session.close()
+    assert [entry['method'] for entry in server.log] == ['GET', 'POST']
+    assert server.log[1]['path'] == '/method/execute'
+    assert server.log[1]['params'] == {'code': 'x' * 200}
+
+
+def test_error_status_raises(server):
+    server.script.append((404, b''))
+    session = HttpSession(timeout=5)
+    with pytest.raises(HttpError) as excInfo:
+        session.request(server.url + 'wall.get', {})
+    session.close()
+    assert excInfo.value.status == 404
+
+
+@pytest.mark.parametrize('status', [500, 503])
+def test_server_errors_are_retried(harvester, server, status):
+    server.script += [(status, b''), (status, b'')]
+    assert harvester.get_response(harvester.api_url + 'wall.get', {}) == {'response': 1}
+    assert len(server.log) == 3
+
+
+@pytest.mark.parametrize('error_code', [1, 10])
+def test_internal_vk_errors_are_retried(harvester, server, error_code):
+    server.script.append((200, {'error': {'error_code': error_code, 'error_msg': 'Internal error'}}))
+    assert harvester.get_response(harvester.api_url + 'wall.get', {}) == {'response': 1}
+    assert len(server.log) == 2
+
+
+@pytest.mark.parametrize('status', [400, 403, 404])
+def test_client_errors_are_not_retried(harvester, server, status):
+    server.script.append((status, b''))
+    assert harvester.get_response(harvester.api_url + 'wall.get', {}) is None
+    assert len(server.log) == 1
+
+
+def test_other_vk_errors_are_not_retried(harvester, server):
+    error = {'error': {'error_code': 15, 'error_msg': 'Access denied'}}
+    server.script.append((200, error))
+    assert harvester.get_response(harvester.api_url + 'wall.get', {}) == error
+    assert len(server.log) == 1
+
+
+def test_wire_bytes_are_recorded(harvester, server):
+    response = {'response': [{'id': i, 'text': 'a' * 100} for i in range(100)]}
+    server.script.append((200, response))
+    assert harvester.get_response(harvester.api_url + 'wall.get', {}) == response
+    nBytes = harvester.stats.snapshot()['methods']['wall.get']['bytes']
+    assert nBytes == len(gzip.compress(json.dumps(response).encode('utf-8')))
+    assert harvester.local.response_bytes == len(json.dumps(response).encode('utf-8'))
+
+
+def test_author_cache_counts_distinct_authors(harvester, server):
+    server.script.append((200, {'response': [{'id': 2, 'first_name': 'A'}, {'id': 3, 'first_name': 'B'}]}))
+    accountDict = {'meta': {'id': 1, 'screen_name': 'club1'}}
+    messages = [{'from_id': authorID} for authorID in [2, 2, 3, -1, 1]]
+    harvester.prefetch_authors(messages, accountDict)
+    for message in messages:
+        harvester.get_author(message, accountDict)
+    harvester.prefetch_authors(messages + [{'from_id': 3}], accountDict)
+    counters = harvester.stats.snapshot()['counters']
+    assert counters['author_cache_misses'] == 2
+    assert counters['author_cache_hits'] == 2
+    assert harvester.stats.snapshot()['author_cache_hit_ratio'] == 0.5
+    assert len(server.log) == 1
+
+
+def test_truncated_gzip_is_retried(harvester, server):
+    server.truncate_gzip = 1
+    assert harvester.get_response(harvester.api_url + 'wall.get', {}) == {'response': 1}
+    assert len(server.log) == 2
+
+
+def test_giving_up_after_max_retries(harvester, server):
+    server.script += [(503, b'')] * 10
+    assert harvester.get_response(harvester.api_url + 'wall.get', {}) is None
+    assert len(server.log) == harvester.max_retries + 1
+
+
+@pytest.mark.parametrize('n_ids', [0, 1, 200, 400, 401])
+def test_account_data_is_requested_in_chunks(harvester, server, n_ids):
+    ids = list(range(1, n_ids + 1))
+    server.script += [(200, {'response': [{'id': i} for i in ids[iStart:iStart + 200]]})
+                      for iStart in range(0, n_ids, 200)]
+    assert harvester.get_users(ids) == [{'id': i} for i in ids]
+    assert len(server.log) == (n_ids + 199) // 200
+    assert all(len(entry['params']['user_ids']) > 0 for entry in server.log)
@@ -0,0 +1,87 @@
+import json
+
+import pytest
+
+from vk_harvester import AuthorRecord, SqliteMetadataStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    metadataStore = SqliteMetadataStore(str(tmp_path / 'userData.sqlite'))
+    yield metadataStore
+    metadataStore.close()
+
+
+def make_store(filename, users):
+    otherStore = SqliteMetadataStore(filename)
+    otherStore.add_users(users)
+    otherStore.close()
+
+
+def test_merge_keeps_record_with_more_fields(store, tmp_path):
+    fullProfile = {'id': 1, 'first_name': 'A', 'last_name': 'B', 'sex': 1,
+                   'screen_name': 'id1', 'followers_count': 10}
+    shortProfile = {'id': 2, 'first_name': 'C', 'last_name': 'D'}
+    store.add_users({'1': fullProfile, '2': shortProfile})
+    otherFilename = str(tmp_path / 'other.sqlite')
+    make_store(otherFilename, {'1': {'id': 1, 'first_name': 'A', 'last_name': 'B'},
+                               '2': dict(shortProfile, sex=2, bdate='1.1.1990'),
+                               '3': {'id': 3, 'first_name': 'E'}})
+    store.merge(otherFilename)
+    assert store.userMetadata['1'].to_dict() == fullProfile
+    assert store.userMetadata['2'].to_dict() == dict(shortProfile, sex=2, bdate='1.1.1990')
+    assert store.userMetadata['3'].first_name == 'E'
+    assert isinstance(store.userMetadata['3'], AuthorRecord)
+
+
+FULL_PROFILE = {'id': 7, 'first_name': 'Ivan', 'last_name': 'Petrov', 'sex': 2, 'bdate': '1.2.1990',
+                'city': {'id': 1, 'title': 'Yoshkar-Ola'}, 'home_town': 'Morki',
+                'screen_name': 'ivan', 'followers_count': 12}
+
+
+def test_author_record_round_trip():
+    record = AuthorRecord.from_dict(FULL_PROFILE)
+    assert record.city == 'Yoshkar-Ola'
+    assert record.to_dict() == FULL_PROFILE
+    assert AuthorRecord.from_dict(record) is record
+
+
+def test_author_record_without_extra():
+    record = AuthorRecord.from_dict(FULL_PROFILE, keep_extra=False)
+    assert record.extra is None
+    assert record.to_dict() == {'id': 7, 'first_name': 'Ivan', 'last_name': 'Petrov', 'sex': 2,
+                                'bdate': '1.2.1990', 'city': {'title': 'Yoshkar-Ola'}, 'home_town': 'Morki'}
+
+
+def test_author_record_essential():
+    record = AuthorRecord.from_dict(FULL_PROFILE)
+    essential = record.essential()
+    assert essential == {'id': 7, 'first_name': 'Ivan', 'last_name': 'Petrov', 'sex': 2,
+                         'city': 'Yoshkar-Ola', 'bdate': '1.2.1990', 'home_town': 'Morki'}
+    assert record.essential() is essential
+    shortRecord = AuthorRecord.from_dict({'id': 8, 'first_name': 'Anna', 'last_name': 'Ivanova'})
+    assert shortRecord.essential() == {'id': 8, 'first_name': 'Anna', 'last_name': 'Ivanova', 'sex': None}
+
+
+def test_import_export_round_trip(store, tmp_path):
+    userData = {'7': FULL_PROFILE, '8': {'id': 8, 'first_name': 'Anna', 'last_name': 'Ivanova'}}
+    userMentions = {'7': ['Ivan', 'Ваня'], '-5': ['some group']}
+    with open(str(tmp_path / 'userData.json'), 'w', encoding='utf-8') as fOut:
+        json.dump(userData, fOut, ensure_ascii=False)
+    with open(str(tmp_path / 'userMentions.json'), 'w', encoding='utf-8') as fOut:
+        json.dump(userMentions, fOut, ensure_ascii=False)
+    store.import_json(str(tmp_path / 'userMentions.json'), str(tmp_path / 'userData.json'))
+    assert store.userMetadata['7'].to_dict() == FULL_PROFILE
+    store.export_json(str(tmp_path / 'exportedMentions.json'), str(tmp_path / 'exportedData.json'))
+    with open(str(tmp_path / 'exportedData.json'), 'r', encoding='utf-8') as fIn:
+        assert json.load(fIn) == userData
+    with open(str(tmp_path / 'exportedMentions.json'), 'r', encoding='utf-8') as fIn:
+        assert json.load(fIn) == {'7': ['Ivan', 'Ваня'], '-5': ['some group']}
+
+
+def test_export_empty_store(store, tmp_path):
+    store.export_json(str(tmp_path / 'exportedMentions.json'), str(tmp_path / 'exportedData.json'))
+    with open(str(tmp_path / 'exportedData.json'), 'r', encoding='utf-8') as fIn:
+        assert json.load(fIn) == {}
+    with open(str(tmp_path / 'exportedMentions.json'), 'r', encoding='utf-8') as fIn:
+        assert json.load(fIn) == {}
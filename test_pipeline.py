@@ -0,0 +1,60 @@
+import threading
+
+from vk_harvester import HarvestPipeline
+
+
+def run_pipeline(pipeline, items):
+    for item in items:
+        pipeline.put(item)
+    return pipeline.close()
+
+
+def test_items_pass_through_all_stages():
+    results = []
+    pipeline = HarvestPipeline([('double', lambda x: 2 * x),
+                                ('add', lambda x: x + 1),
+                                ('collect', results.append)], queue_size=2)
+    assert run_pipeline(pipeline, range(10))
+    assert results == [2 * i + 1 for i in range(10)]
+
+
+def test_failed_stage_drops_remaining_items():
+    results = []
+
+    def check(x):
+        if x == 3:
+            raise ValueError('broken item')
+        return x
+
+    pipeline = HarvestPipeline([('check', check), ('collect', results.append)], queue_size=2)
+    assert not run_pipeline(pipeline, range(10))
+    # The items that were still queued when the stage failed may be dropped too
+    assert results == [0, 1, 2][:len(results)]
+
+
+def test_failed_start_does_not_block():
+    local = threading.local()
+    lock = threading.Lock()
+    starts = []
+    stops = []
+
+    def on_start():
+        with lock:
+            starts.append(len(starts))
+            if len(starts) == 2:
+                raise OSError('no connection')
+        local.started = True
+
+    def on_stop():
+        stops.append(local.started)
+
+    results = []
+    pipeline = HarvestPipeline([('first', lambda x: x), ('second', lambda x: x), ('collect', results.append)],
+                               queue_size=1, on_start=on_start, on_stop=on_stop)
+    closer = threading.Thread(target=run_pipeline, args=(pipeline, range(20)), daemon=True)
+    closer.start()
+    closer.join(timeout=5)
+    assert not closer.is_alive()
+    assert pipeline.failed
+    assert results == []
+    assert stops == [True, True]
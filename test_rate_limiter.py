@@ -0,0 +1,124 @@
+import pytest
+
+from vk_harvester import RateLimiter
+
+
+class FakeClock:
+    """
+    Virtual time for RateLimiter: sleeping only moves the clock forward.
+    """
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def make_limiter(**kwargs):
+    fakeClock = FakeClock()
+    limiter = RateLimiter(clock=fakeClock.clock, sleep=fakeClock.sleep, **kwargs)
+    return limiter, fakeClock
+
+
+def send_times(limiter, fake_clock, n):
+    times = []
+    for i in range(n):
+        limiter.wait()
+        times.append(fake_clock.now)
+    return times
+
+
+def test_no_sleep_within_rate():
+    limiter, fakeClock = make_limiter(rate=3, period=1.0)
+    assert send_times(limiter, fakeClock, 3) == [0.0, 0.0, 0.0]
+    assert fakeClock.sleeps == []
+
+
+def test_sleeps_until_window_ends():
+    limiter, fakeClock = make_limiter(rate=3, period=1.0)
+    times = send_times(limiter, fakeClock, 7)
+    assert times == pytest.approx([0, 0, 0, 1, 1, 1, 2])
+    assert limiter.sleepTime == pytest.approx(2.0)
+
+
+def test_only_remaining_time_is_slept():
+    limiter, fakeClock = make_limiter(rate=1, period=1.0)
+    limiter.wait()
+    fakeClock.now += 0.7
+    limiter.wait()
+    assert fakeClock.sleeps == [pytest.approx(0.3)]
+
+
+@pytest.mark.parametrize('rate', [0.5, 1.0, 2.5, 3.0, 7.3])
+def test_non_integer_rates(rate):
+    limiter, fakeClock = make_limiter(rate=rate, period=1.0)
+    times = send_times(limiter, fakeClock, 30)
+    # The rate is never exceeded in any window of the period length...
+    for i in range(len(times)):
+        nInWindow = sum(1 for t in times if times[i] <= t < times[i] + 1.0 - 1e-9)
+        assert nInWindow <= max(1, rate)
+    # ...and the whole number of requests allowed per window is used
+    capacity = max(1, int(rate))
+    window = max(1.0, 1.0 / rate)
+    assert times[-1] == pytest.approx((len(times) - 1) // capacity * window)
+
+
+def test_rate_must_be_positive():
+    with pytest.raises(ValueError):
+        RateLimiter(rate=0)
+
+
+def test_backoff_too_many_requests_doubles():
+    limiter, fakeClock = make_limiter(rate=3, period=1.0)
+    assert limiter.backoff(6)
+    assert limiter.delay() == pytest.approx(1.0)
+    assert limiter.backoff(6)
+    assert limiter.delay() == pytest.approx(2.0)
+    assert limiter.backoff(6)
+    assert limiter.delay() == pytest.approx(4.0)
+    limiter.wait()
+    assert fakeClock.now == pytest.approx(4.0)
+
+
+@pytest.mark.parametrize('error_code', [9, 29])
+def test_backoff_flood_control(error_code):
+    limiter, fakeClock = make_limiter(rate=3, period=1.0, flood_pause=60.0, max_pause=1000.0)
+    limiter.backoff(error_code)
+    assert limiter.delay() == pytest.approx(60.0)
+    limiter.backoff(error_code)
+    assert limiter.delay() == pytest.approx(120.0)
+
+
+def test_backoff_is_capped():
+    limiter, fakeClock = make_limiter(rate=3, period=1.0, flood_pause=60.0, max_pause=100.0)
+    for i in range(5):
+        limiter.backoff(9)
+    assert limiter.delay() == pytest.approx(100.0)
+
+
+def test_success_resets_backoff():
+    limiter, fakeClock = make_limiter(rate=3, period=1.0)
+    limiter.backoff(6)
+    limiter.backoff(6)
+    limiter.wait()
+    limiter.success()
+    limiter.backoff(6)
+    assert limiter.delay() == pytest.approx(1.0)
+
+
+def test_other_errors_are_not_rate_limits():
+    limiter, fakeClock = make_limiter(rate=3, period=1.0)
+    assert not limiter.backoff(10)
+    assert limiter.delay() == 0.0
+
+
+def test_pause():
+    limiter, fakeClock = make_limiter(rate=3, period=1.0)
+    limiter.pause(5.0)
+    limiter.wait()
+    assert fakeClock.now == pytest.approx(5.0)
@@ -0,0 +1,67 @@
+import pytest
+
+from vk_harvester import RepostStore
+
+
+@pytest.fixture
+def fname(tmp_path):
+    return str(tmp_path / 'reposts.jsonl')
+
+
+def test_add_deduplicates(fname):
+    store = RepostStore(fname)
+    assert store.add(-1, 10, 'text') == ('-1_10', True)
+    assert store.add(-1, 10, 'text') == ('-1_10', False)
+    assert store.add(-1, 11, 'другой текст') == ('-1_11', True)
+    assert store.get('-1_11') == 'другой текст'
+    assert store.get('-1_12') is None
+    store.close()
+
+
+def test_reopened_store(fname):
+    store = RepostStore(fname)
+    store.add(-1, 10, 'first')
+    store.add(5, 20, 'second\nline')
+    store.close()
+    store = RepostStore(fname)
+    assert '-1_10' in store and '5_20' in store
+    assert store.add(5, 20, 'second\nline') == ('5_20', False)
+    posts = {1: {'text': '', 'copy_ref': '5_20'}, 2: {'text': 'no repost'}, 3: {'text': '', 'copy_ref': '7_7'}}
+    store.resolve_posts(posts)
+    assert posts[1] == {'text': '', 'copy_text': 'second\nline'}
+    assert posts[2] == {'text': 'no repost'}
+    assert posts[3] == {'text': '', 'copy_ref': '7_7'}
+    store.close()
+    with open(fname, 'r', encoding='utf-8') as fIn:
+        assert len(fIn.readlines()) == 2
+
+
+def test_truncated_last_record(fname):
+    store = RepostStore(fname)
+    store.add(-1, 10, 'first')
+    store.close()
+    with open(fname, 'a', encoding='utf-8') as fOut:
+        fOut.write('{"key": "-1_11", "te')
+    store = RepostStore(fname)
+    assert '-1_11' not in store
+    store.add(-1, 12, 'third')
+    store.close()
+    store = RepostStore(fname)
+    assert store.get('-1_10') == 'first'
+    assert store.get('-1_12') == 'third'
+    store.close()
+
+
+def test_merge(fname, tmp_path):
+    store = RepostStore(fname)
+    store.add(-1, 10, 'first')
+    otherStore = RepostStore(str(tmp_path / 'other.jsonl'))
+    otherStore.add(-1, 10, 'first')
+    otherStore.add(-2, 20, 'second')
+    otherStore.close()
+    assert store.merge(str(tmp_path / 'other.jsonl')) == 1
+    assert store.get('-2_20') == 'second'
+    store.close()
+    store = RepostStore(fname)
+    assert store.get('-2_20') == 'second'
+    store.close()
@@ -0,0 +1,107 @@
+import json
+import os
+
+import pytest
+
+from vk_corpus import CorpusReader, CorpusShard, convert_dumps, read_dump
+
+
+def make_post(n_day, text):
+    return {'date': '2019-05-' + str(n_day).zfill(2) + ' 12:00:00', 'text': text,
+            'author': 'someone', 'comments': {}, 'sort': n_day}
+
+
+@pytest.fixture
+def lang_dir(tmp_path):
+    """
+    A harvested language directory with a group in JSON, a user in
+    JSON lines whose last update has not been finished, and files
+    that are not accounts.
+    """
+    langDir = tmp_path / 'xx'
+    os.makedirs(str(langDir / 'users'))
+    posts = {str(i): make_post(i, 'group post ' + str(i)) for i in range(1, 11)}
+    with open(str(langDir / 'club1.json'), 'w', encoding='utf-8') as fOut:
+        json.dump({'meta': {'id': 1, 'screen_name': 'club1'}, 'posts': posts}, fOut)
+    records = [dict(make_post(20, 'user post 1'), type='post', id=1),
+               dict(make_post(21, 'user post 2'), type='post', id=2),
+               {'type': 'meta', 'meta': {'id': 5, 'screen_name': 'user5'}},
+               dict(make_post(22, 'changed user post 2'), type='post', id=2),
+               {'type': 'meta', 'meta': {'id': 5, 'screen_name': 'user5', 'updated': True}},
+               dict(make_post(23, 'unfinished update'), type='post', id=3)]
+    with open(str(langDir / 'users' / 'user5.jsonl'), 'w', encoding='utf-8') as fOut:
+        for record in records:
+            fOut.write(json.dumps(record, sort_keys=True) + '\n')
+        fOut.write('{"date": "2019-05-24')
+    for fname in ['manifest.json', 'club1.state.json', 'club2.jsonl.part']:
+        (langDir / fname).write_text('{}', encoding='utf-8')
+    return str(langDir)
+
+
+@pytest.fixture
+def corpus(lang_dir, tmp_path):
+    corpusDir = str(tmp_path / 'corpus')
+    convert_dumps(lang_dir, corpusDir, block_size=2, shard_bytes=300)
+    with CorpusReader(corpusDir) as reader:
+        yield reader
+
+
+def test_read_dump_ignores_unfinished_update(lang_dir):
+    meta, posts = read_dump(os.path.join(lang_dir, 'users', 'user5.jsonl'))
+    assert meta['updated']
+    assert sorted(posts) == [1, 2]
+    assert posts[2]['text'] == 'changed user post 2'
+
+
+def test_read_dump_without_meta(tmp_path):
+    filename = str(tmp_path / 'user6.jsonl')
+    with open(filename, 'w', encoding='utf-8') as fOut:
+        fOut.write(json.dumps(dict(make_post(1, 'post'), type='post', id=1)) + '\n')
+    meta, posts = read_dump(filename)
+    assert meta is None
+
+
+def test_shards_roll_over(corpus, tmp_path):
+    shards = sorted(fname for fname in os.listdir(str(tmp_path / 'corpus')) if fname.endswith('.jsonl.gz'))
+    assert len(shards) > 1
+    assert len(corpus.shards) == len(shards)
+    for fname in shards:
+        assert os.path.exists(str(tmp_path / 'corpus' / fname.replace('.jsonl.gz', '.index.json')))
+
+
+def test_round_trip(corpus):
+    assert corpus.accounts() == {'club1': {'id': 1, 'screen_name': 'club1'},
+                                 'users/user5': {'id': 5, 'screen_name': 'user5', 'updated': True}}
+    posts = list(corpus.posts())
+    assert len(posts) == 12
+    assert sorted(post['id'] for post in posts if post['account'] == 'club1') == list(range(1, 11))
+    post = corpus.get_post('club1', 7)
+    assert post['text'] == 'group post 7'
+    assert post['date'] == '2019-05-07 12:00:00'
+    assert corpus.get_post('users/user5', 2)['text'] == 'changed user post 2'
+    assert corpus.get_post('users/user5', 3) is None
+    assert corpus.get_post('club1', 11) is None
+
+
+def test_accounts_filter(corpus):
+    posts = list(corpus.posts(accounts=['users/user5']))
+    assert sorted(post['id'] for post in posts) == [1, 2]
+
+
+def test_date_filter_skips_blocks(corpus, monkeypatch):
+    nBlocks = sum(len(shard.index['blocks']) for shard in corpus.shards)
+    blocksRead = []
+    readBlock = CorpusShard.read_block
+
+    def read_block(shard, n_block):
+        blocksRead.append((shard.filename, n_block))
+        return readBlock(shard, n_block)
+
+    monkeypatch.setattr(CorpusShard, 'read_block', read_block)
+    posts = list(corpus.posts(date_from='2019-05-03', date_to='2019-05-05'))
+    assert sorted(post['id'] for post in posts) == [3, 4]
+    assert 0 < len(blocksRead) < nBlocks
+    posts = list(corpus.posts(date_from='2019-05-22'))
+    assert [(post['account'], post['id']) for post in posts] == [('users/user5', 2)]
+    posts = list(corpus.posts(date_to='2019-05'))
+    assert posts == []
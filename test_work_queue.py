@@ -0,0 +1,85 @@
+import time
+
+import pytest
+
+from vk_harvester import WorkQueue
+
+
+@pytest.fixture
+def queues(tmp_path):
+    """
+    Two workers sharing one queue with short leases.
+    """
+    fname = str(tmp_path / 'workQueue.sqlite')
+    queue1 = WorkQueue(fname, worker_id='worker1', lease_time=0.2, max_attempts=2)
+    queue2 = WorkQueue(fname, worker_id='worker2', lease_time=0.2, max_attempts=2)
+    queue1.add('xx', ['club1', 'club2'])
+    queue2.add('xx', ['club2', 'club3'])
+    yield queue1, queue2
+    queue1.close()
+    queue2.close()
+
+
+def test_workers_get_different_accounts(queues):
+    queue1, queue2 = queues
+    assert queue1.lease('xx') == 'club1'
+    assert queue2.lease('xx') == 'club2'
+    assert queue1.lease('xx') == 'club3'
+    assert queue2.lease('xx') is None
+    assert queue1.lease('yy') is None
+    assert queue1.counts('xx') == {'pending': 0, 'leased': 3, 'done': 0, 'failed': 0}
+
+
+def test_finish(queues):
+    queue1, queue2 = queues
+    url = queue1.lease('xx')
+    assert not queue2.finish('xx', url)
+    assert queue1.finish('xx', url)
+    assert queue1.counts('xx') == {'pending': 2, 'leased': 0, 'done': 1, 'failed': 0}
+    assert queue2.lease('xx') == 'club2'
+
+
+def test_expired_lease_is_reclaimed(queues):
+    queue1, queue2 = queues
+    assert queue1.lease('xx') == 'club1'
+    assert queue2.lease('xx') == 'club2'
+    assert queue2.lease('xx') == 'club3'
+    time.sleep(0.3)
+    queue2.renew()
+    # Only the lease of the first worker, who did not renew it, has expired
+    assert queue2.lease('xx') == 'club1'
+    assert not queue1.finish('xx', 'club1')
+    assert queue2.finish('xx', 'club1')
+
+
+def test_heartbeat_keeps_lease(queues):
+    queue1, queue2 = queues
+    assert queue1.lease('xx') == 'club1'
+    queue1.start_heartbeat(interval=0.05)
+    time.sleep(0.3)
+    assert queue2.lease('xx') == 'club2'
+    assert queue2.lease('xx') == 'club3'
+    assert queue2.lease('xx') is None
+    queue1.stop_heartbeat()
+    assert queue1.finish('xx', 'club1')
+
+
+def test_max_attempts(queues):
+    queue1, queue2 = queues
+    for queue in [queue1, queue2]:
+        assert queue.lease('xx') == 'club1'
+        assert queue.finish('xx', 'club1', success=False)
+    assert queue1.lease('xx') == 'club2'
+    assert queue1.counts('xx') == {'pending': 1, 'leased': 1, 'done': 0, 'failed': 1}
+
+
+def test_expired_leases_count_as_attempts(queues):
+    queue1, queue2 = queues
+    assert queue1.lease('xx') == 'club1'
+    time.sleep(0.3)
+    assert queue2.lease('xx') == 'club1'
+    time.sleep(0.3)
+    # club1 has been leased max_attempts times and is not given out again
+    assert queue1.lease('xx') == 'club2'
+    assert queue1.lease('xx') == 'club3'
+    assert queue1.lease('xx') is None
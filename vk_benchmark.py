@@ -0,0 +1,458 @@
+"""
+Offline benchmark for VkHarvester. It starts a local server that imitates
+the parts of the vk API used by the harvester (wall.get, wall.getComments,
+users.get, groups.getById and execute with the scripts generated by
+the harvester), fills it with synthetic walls and runs a complete harvest
+against it. Usage example:
+
+python3 vk_benchmark.py --groups 5 --posts 2000 --comments-mean 4 --error-rate 0.02
+"""
+
+import argparse
+import contextlib
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse as parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import vk_harvester
+
+
+class MockVkApi:
+    """
+    Synthetic vk data and the API methods that serve it. Walls belong to
+    groups club1..clubN and users id1..idM (the users with walls are
+    the first ones). Comments are generated on request from the post ID,
+    so that large walls do not take much memory.
+    """
+    rxLoop = re.compile('while \\(offset < ([0-9]+) && \\(offset \\+ ([0-9]+)\\) < ([0-9]+)\\)\\{'
+                        '(?:objs = objs \\+ |items = )API\\.(wall\\.get|wall\\.getComments)\\('
+                        '(\\{.*?), "count": "100", "offset": offset \\+ [0-9]+\\}\\)\\.items;')
+    rxProjectedReturn = re.compile('return \\{(.*)\\};$')
+    rxCall = re.compile('API\\.(wall\\.get|wall\\.getComments)\\((\\{[^()]*\\})\\)(\\.items)?')
+    rxProjection = re.compile('"([a-z_]+)": items@\\.')
+
+    def __init__(self, n_groups=3, n_walls_users=1, n_posts=1000, comments_mean=3.0,
+                 long_thread_share=0.01, n_authors=5000, error_rate=0.0,
+                 max_response_bytes=5000000, seed=1):
+        self.rand = random.Random(seed)
+        self.seed = seed
+        self.commentsMean = comments_mean
+        self.longThreadShare = long_thread_share
+        self.nAuthors = n_authors
+        self.errorRate = error_rate
+        self.maxResponseBytes = max_response_bytes
+        self.walls = {}
+        self.postIndex = {}
+        self.groups = {}
+        self.stats = {'requests': 0, 'errors_injected': 0, 'bytes_sent': 0,
+                      'methods': {}, 'inner_calls': {}}
+        self.lock = threading.Lock()
+        for i in range(1, n_groups + 1):
+            self.groups[i] = {'id': i, 'name': 'Group ' + str(i), 'screen_name': 'club' + str(i),
+                              'is_closed': 0, 'type': 'group', 'members_count': self.rand.randint(10, 10000)}
+            self.walls[-i] = self.make_wall(-i, n_posts)
+        for i in range(1, n_walls_users + 1):
+            self.walls[i] = self.make_wall(i, n_posts // 10 + 1)
+
+    def make_wall(self, owner_id, n_posts):
+        """
+        Generate a wall with n_posts posts, the newest first.
+        """
+        posts = []
+        for postId in range(n_posts, 0, -1):
+            if self.rand.random() < self.longThreadShare:
+                nComments = self.rand.randint(101, 600)
+            else:
+                nComments = int(self.rand.expovariate(1 / self.commentsMean)) if self.commentsMean > 0 else 0
+            if self.rand.random() < 0.6:
+                fromId = owner_id
+            else:
+                fromId = self.rand.randint(1, self.nAuthors)
+            post = {'id': postId, 'owner_id': owner_id, 'from_id': fromId,
+                    'date': 1400000000 + postId * 3600,
+                    'text': 'Post ' + str(postId) + ' on the wall of [club' + str(abs(owner_id)) +
+                            '|community] ' + 'lorem ipsum ' * self.rand.randint(1, 30),
+                    'comments': {'count': nComments, 'can_post': 1, 'groups_can_post': True},
+                    'likes': {'count': self.rand.randint(0, 500), 'user_likes': 0, 'can_like': 1},
+                    'reposts': {'count': self.rand.randint(0, 20), 'user_reposted': 0},
+                    'views': {'count': self.rand.randint(100, 10000)},
+                    'post_type': 'post', 'marked_as_ads': 0,
+                    'attachments': [{'type': 'photo',
+                                     'photo': {'id': postId, 'album_id': -7, 'owner_id': owner_id,
+                                               'sizes': [{'type': t, 'url': 'https://example.com/' + t +
+                                                          str(postId) + '.jpg', 'width': 100, 'height': 100}
+                                                         for t in 'smxyzw']}}]}
+            if self.rand.random() < 0.1:
+                post['copy_history'] = [{'id': self.rand.randint(1, 50), 'owner_id': -1000,
+                                         'from_id': -1000, 'date': post['date'] - 100, 'post_type': 'post',
+                                         'text': 'Shared text [id1|someone] ' + 'dolor sit amet ' * 10}]
+            posts.append(post)
+            self.postIndex[(owner_id, postId)] = post
+        if len(posts) > 1:
+            posts[-1]['is_pinned'] = 1
+            posts.insert(0, posts.pop())
+        return posts
+
+    def comments(self, owner_id, post_id):
+        """
+        Generate the comments to a post.
+        """
+        post = self.postIndex.get((owner_id, post_id))
+        if post is None:
+            return []
+        rand = random.Random(self.seed * 1000003 + owner_id * 7919 + post_id)
+        return [{'id': post_id * 10000 + i, 'from_id': rand.randint(1, self.nAuthors),
+                 'post_id': post_id, 'owner_id': owner_id, 'date': post['date'] + i * 60,
+                 'text': 'Comment ' + str(i) + ' ' + 'consectetur ' * rand.randint(1, 10),
+                 'likes': {'count': rand.randint(0, 10)}, 'thread': {'count': 0, 'items': []}}
+                for i in range(post['comments']['count'])]
+
+    def count_call(self, key, method, n=1):
+        with self.lock:
+            self.stats[key][method] = self.stats[key].get(method, 0) + n
+
+    def wall_get(self, params):
+        wall = self.walls.get(int(params['owner_id']), [])
+        offset = int(params.get('offset', 0))
+        return {'count': len(wall), 'items': wall[offset:offset + int(params.get('count', 20))]}
+
+    def wall_get_comments(self, params):
+        comments = self.comments(int(params['owner_id']), int(params['post_id']))
+        offset = int(params.get('offset', 0))
+        return {'count': len(comments), 'items': comments[offset:offset + int(params.get('count', 10))]}
+
+    def call(self, method, params):
+        """
+        Make an API call inside an execute script.
+        """
+        self.count_call('inner_calls', method)
+        if method == 'wall.get':
+            return self.wall_get(params)
+        return self.wall_get_comments(params)
+
+    def users_get(self, params):
+        result = []
+        for userId in params.get('user_ids', '').split(','):
+            userId = userId.strip()
+            if userId.startswith('id'):
+                userId = userId[2:]
+            if not userId.isdigit() or not 0 < int(userId) <= self.nAuthors:
+                continue
+            userId = int(userId)
+            result.append({'id': userId, 'first_name': 'Name' + str(userId),
+                           'last_name': 'Surname' + str(userId), 'sex': userId % 2 + 1,
+                           'screen_name': 'id' + str(userId), 'bdate': '1.1.1990',
+                           'city': {'id': 1, 'title': 'City'}, 'country': {'id': 1, 'title': 'Country'},
+                           'home_town': 'Town', 'domain': 'id' + str(userId), 'followers_count': 10,
+                           'occupation': {'type': 'work', 'name': 'Company'},
+                           'career': [], 'schools': [], 'universities': []})
+        return result
+
+    def groups_get_by_id(self, params):
+        result = []
+        for groupId in params.get('group_ids', '').split(','):
+            groupId = re.sub('^(club|public)', '', groupId.strip())
+            if groupId.isdigit() and int(groupId) in self.groups:
+                result.append(self.groups[int(groupId)])
+        return result
+
+    @staticmethod
+    def project(items, fields):
+        return {field: [item.get(field) for item in items] for field in fields}
+
+    def execute(self, code):
+        """
+        Run a VKScript snippet. Only the kinds of scripts generated
+        by VkHarvester are understood.
+        """
+        m = self.rxLoop.search(code)
+        if m is not None:
+            limit, start, total, method, args = m.groups()
+            args = json.loads(args + '}')
+            items = []
+            offset = 0
+            while offset < int(limit) and offset + int(start) < int(total):
+                params = dict(args)
+                params.update({'count': 100, 'offset': offset + int(start)})
+                items += self.call(method, params)['items']
+                offset += 100
+            projection = self.rxProjectedReturn.search(code)
+            if code.startswith('var objs') or projection is None:
+                return items
+            fields = re.findall('"([a-z_]+)": f[0-9]+', projection.group(1))
+            return self.project(items, fields)
+        if code.startswith('var wall;'):
+            # Pre-pass: number of posts and the first posts of each wall
+            result = []
+            for method, args, items in self.rxCall.findall(code):
+                response = self.call(method, json.loads(args))
+                result.append({'count': response['count'],
+                               'id': [post['id'] for post in response['items']],
+                               'date': [post['date'] for post in response['items']]})
+            return result
+        if code.startswith('return [') or 'result.push(' in code:
+            result = []
+            fields = None
+            m = re.search('result\\.push\\((\\{.*?\\})\\);', code)
+            if m is not None:
+                fields = self.rxProjection.findall(m.group(1))
+            for method, args, items in self.rxCall.findall(code):
+                response = self.call(method, json.loads(args))
+                if fields is not None:
+                    result.append(self.project(response['items'], fields))
+                else:
+                    result.append(response['items'])
+            return result
+        raise ValueError('Unknown script')
+
+    def handle(self, method, params):
+        """
+        Process an API request and return the response object.
+        """
+        with self.lock:
+            self.stats['requests'] += 1
+            injectError = self.rand.random() < self.errorRate
+            if injectError:
+                self.stats['errors_injected'] += 1
+                errorCode = self.rand.choice([6, 10])
+        self.count_call('methods', method)
+        if injectError:
+            return {'error': {'error_code': errorCode, 'error_msg': 'Injected error'}}
+        if method == 'wall.get':
+            return {'response': self.wall_get(params)}
+        if method == 'wall.getComments':
+            return {'response': self.wall_get_comments(params)}
+        if method == 'users.get':
+            return {'response': self.users_get(params)}
+        if method == 'groups.getById':
+            return {'response': self.groups_get_by_id(params)}
+        if method == 'execute':
+            try:
+                return {'response': self.execute(params.get('code', ''))}
+            except ValueError:
+                return {'error': {'error_code': 12, 'error_msg': 'Unable to compile code'}}
+        return {'error': {'error_code': 3, 'error_msg': 'Unknown method passed'}}
+
+
+class MockVkHandler(BaseHTTPRequestHandler):
+    """
+    HTTP front end of MockVkApi with keep-alive and gzip.
+    """
+    protocol_version = 'HTTP/1.1'
+    # Otherwise, the headers and the body sent separately wait for delayed ACKs
+    disable_nagle_algorithm = True
+    api = None
+    latency = 0.0
+    http_error_rate = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        urlParts = parse.urlsplit(self.path)
+        self.reply(urlParts.path, dict(parse.parse_qsl(urlParts.query)))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.reply(parse.urlsplit(self.path).path, dict(parse.parse_qsl(body.decode('utf-8'))))
+
+    def reply(self, path, params):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if path == '/stats':
+            body = json.dumps(self.api.stats).encode('utf-8')
+        elif random.random() < self.http_error_rate:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        else:
+            response = self.api.handle(path.split('/')[-1], params)
+            body = json.dumps(response, ensure_ascii=False).encode('utf-8')
+            if len(body) > self.api.maxResponseBytes:
+                body = json.dumps({'error': {'error_code': 13,
+                                             'error_msg': 'Response size is too big'}}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.api.lock:
+            self.api.stats['bytes_sent'] += len(body)
+
+
+def serve(port_queue, api_args, latency, http_error_rate):
+    """
+    Run the mock server (in a separate process) and put its port to the queue.
+    """
+    MockVkHandler.api = MockVkApi(**api_args)
+    MockVkHandler.latency = latency
+    MockVkHandler.http_error_rate = http_error_rate
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MockVkHandler)
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+def get_server_stats(port):
+    session = vk_harvester.HttpSession()
+    body, nWireBytes = session.request('http://127.0.0.1:' + str(port) + '/stats', {})
+    stats = json.loads(body.decode('utf-8'))
+    session.close()
+    return stats
+
+
+def count_output(lang):
+    """
+    Count the posts and comments in the harvested files.
+    """
+    nPosts = nComments = 0
+    for root, dirs, files in os.walk(lang):
+        for fname in files:
+            if fname.endswith('.state.json') or fname == 'manifest.json':
+                continue
+            with open(os.path.join(root, fname), 'r', encoding='utf-8') as fIn:
+                if fname.endswith('.jsonl'):
+                    posts = [json.loads(line) for line in fIn]
+                    posts = [post for post in posts if post['type'] == 'post']
+                else:
+                    posts = list(json.load(fIn)['posts'].values())
+            nPosts += len(posts)
+            nComments += sum(len(post['comments']) for post in posts)
+    return nPosts, nComments
+
+
+def run_benchmark(args):
+    """
+    Start the mock server, harvest everything from it in a temporary
+    directory and return a dictionary with the results.
+    """
+    apiArgs = {'n_groups': args.groups, 'n_walls_users': args.users, 'n_posts': args.posts,
+               'comments_mean': args.comments_mean, 'long_thread_share': args.long_threads,
+               'n_authors': args.authors, 'error_rate': args.error_rate, 'seed': args.seed}
+    portQueue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(portQueue, apiArgs, args.latency, args.http_error_rate),
+                                     daemon=True)
+    server.start()
+    port = portQueue.get()
+    cwd = os.getcwd()
+    workDir = tempfile.mkdtemp(prefix='vk_benchmark_')
+    try:
+        os.chdir(workDir)
+        with open('bench_vk_urls.txt', 'w', encoding='utf-8') as fOut:
+            for i in range(1, args.groups + 1):
+                fOut.write('https://vk.com/club' + str(i) + '\n')
+            for i in range(1, args.users + 1):
+                fOut.write('https://vk.com/id' + str(i) + '\n')
+        with open('config.txt', 'w', encoding='utf-8') as fOut:
+            for i in range(args.tokens):
+                fOut.write('benchmark_token_' + str(i) + ' ' + str(args.rate) + '\n')
+        log = io.StringIO()
+        timeStart = time.monotonic()
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else log):
+            repostStore = None
+            if args.dedupe_reposts:
+                repostStore = vk_harvester.RepostStore('reposts.jsonl')
+            harvester = vk_harvester.VkHarvester('bench', output_format=args.output_format,
+                                                 repost_store=repostStore)
+            harvester.api_url = 'http://127.0.0.1:' + str(port) + '/method/'
+            harvester.retry_delay = 0.05
+            harvester.pipeline = args.pipeline
+            harvester.make_dir()
+            harvester.harvest(overwrite_downloaded=True, prepass=not args.no_prepass)
+            harvester.save_user_ids()
+            elapsed = time.monotonic() - timeStart
+            nPosts, nComments = count_output('bench')
+            harvesterStats = harvester.stats.snapshot()
+            rerun = None
+            if args.rerun:
+                # Harvest again without any changes on the walls
+                nRequests = get_server_stats(port)['requests']
+                timeStart = time.monotonic()
+                harvester.harvest(incremental=True, prepass=not args.no_prepass)
+                rerun = {'elapsed_s': round(time.monotonic() - timeStart, 3),
+                         'requests': get_server_stats(port)['requests'] - nRequests}
+            if repostStore is not None:
+                repostStore.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workDir, ignore_errors=True)
+    stats = get_server_stats(port)
+    server.terminate()
+    nInnerCalls = sum(stats['inner_calls'].values()) + sum(n for method, n in stats['methods'].items()
+                                                           if method != 'execute')
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peakRss //= 1024
+    return {'elapsed_s': round(elapsed, 3),
+            'requests': stats['requests'],
+            'requests_per_s': round(stats['requests'] / elapsed, 2),
+            'posts': nPosts,
+            'comments': nComments,
+            'posts_per_s': round(nPosts / elapsed, 2),
+            'comments_per_s': round(nComments / elapsed, 2),
+            'requests_per_post': round(stats['requests'] / max(nPosts, 1), 4),
+            'api_calls_per_post': round(nInnerCalls / max(nPosts, 1), 4),
+            'bytes_received': stats['bytes_sent'],
+            'errors_injected': stats['errors_injected'],
+            'methods': stats['methods'],
+            'peak_rss_mb': round(peakRss / 1024, 1),
+            'author_cache_hit_ratio': harvesterStats['author_cache_hit_ratio'],
+            'reposts_stored': harvesterStats['counters'].get('reposts_stored', 0),
+            'reposts_deduplicated': harvesterStats['counters'].get('reposts_deduplicated', 0),
+            'timers_s': harvesterStats['timers_s'],
+            'incremental_rerun': rerun}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark VkHarvester against a local mock of the vk API.')
+    parser.add_argument('--groups', type=int, default=3, help='number of groups')
+    parser.add_argument('--users', type=int, default=1, help='number of user walls')
+    parser.add_argument('--posts', type=int, default=1000, help='posts per group wall')
+    parser.add_argument('--comments-mean', type=float, default=3.0, help='mean number of comments per post')
+    parser.add_argument('--long-threads', type=float, default=0.01,
+                        help='share of posts with more than 100 comments')
+    parser.add_argument('--authors', type=int, default=5000, help='number of distinct comment authors')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='share of requests answered with vk errors 6 or 10')
+    parser.add_argument('--http-error-rate', type=float, default=0.0,
+                        help='share of requests answered with HTTP 503')
+    parser.add_argument('--latency', type=float, default=0.0, help='server latency per request, in seconds')
+    parser.add_argument('--tokens', type=int, default=1, help='number of access tokens')
+    parser.add_argument('--rate', type=float, default=1000, help='requests per second allowed per token')
+    parser.add_argument('--output-format', default='json', choices=sorted(vk_harvester.VkHarvester.writers))
+    parser.add_argument('--dedupe-reposts', action='store_true', help='store reposted texts in a RepostStore')
+    parser.add_argument('--pipeline', action='store_true', help='process each account in a pipeline of threads')
+    parser.add_argument('--no-prepass', action='store_true', help='do not check the walls before harvesting')
+    parser.add_argument('--rerun', action='store_true',
+                        help='harvest again incrementally and report the cost of the second run')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='append the results as a JSON line to this file')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the harvester')
+    args = parser.parse_args()
+    results = run_benchmark(args)
+    for k in sorted(results):
+        print(k + ':', results[k])
+    if args.json is not None:
+        results['args'] = vars(args)
+        with open(args.json, 'a', encoding='utf-8') as fOut:
+            fOut.write(json.dumps(results, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
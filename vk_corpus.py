@@ -0,0 +1,346 @@
+"""
+Compact corpus format for the harvested posts, and a reader for it.
+
+A corpus is a directory of shards. Each shard (shard-NNNNN.jsonl.gz)
+is a sequence of independently gzipped blocks of JSON lines, one post
+(with its comments) per line, so the whole shard can also be read with
+zcat. Next to each shard, there is an index (shard-NNNNN.index.json)
+with the offset and the date range of each block, the block of each post
+and the metadata of the accounts. This way, a post can be found by its
+ID, or the posts can be filtered by date, without decompressing the
+blocks that do not contain anything relevant.
+
+Each line contains the post as it was written by the harvester, with
+two additional keys: account (the path of the account's file relative
+to the language directory, without the extension, e.g. "somegroup" or
+"users/someuser") and id.
+
+Convert the JSON or JSON lines files written by the harvester:
+python3 vk_corpus.py mhr mhr_corpus
+"""
+
+import argparse
+import gzip
+import json
+import mmap
+import os
+import zlib
+
+
+class CorpusWriter:
+    """
+    Write posts to the shards of a corpus in out_dir. A block is
+    compressed when it has block_size posts or block_bytes bytes of
+    JSON, and a new shard is started when the current one has grown
+    beyond shard_bytes bytes.
+    """
+    def __init__(self, out_dir, block_size=1000, block_bytes=1000000, shard_bytes=1000000000):
+        self.out_dir = out_dir
+        self.block_size = block_size
+        self.block_bytes = block_bytes
+        self.shard_bytes = shard_bytes
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        self.nShards = 0
+        self.fShard = None
+        self.index = None
+        self.blockLines = []
+        self.blockBytes = 0
+        self.blockAccounts = set()
+        self.blockDates = []
+
+    def shard_filename(self, n_shard):
+        return os.path.join(self.out_dir, 'shard-' + str(n_shard).zfill(5) + '.jsonl.gz')
+
+    def open_shard(self):
+        self.fShard = open(self.shard_filename(self.nShards), 'wb')
+        self.index = {'version': 1, 'blocks': [], 'posts': {}, 'accounts': {}}
+
+    def close_shard(self):
+        """
+        Write the last block of the current shard and its index.
+        """
+        self.flush_block()
+        if self.fShard is None:
+            return
+        self.fShard.close()
+        indexFilename = self.shard_filename(self.nShards)[:-len('.jsonl.gz')] + '.index.json'
+        with open(indexFilename, 'w', encoding='utf-8') as fIndex:
+            json.dump(self.index, fIndex, ensure_ascii=False, sort_keys=True)
+        self.fShard = None
+        self.index = None
+        self.nShards += 1
+
+    def flush_block(self):
+        """
+        Compress the posts collected so far and append them to the shard.
+        """
+        if len(self.blockLines) <= 0:
+            return
+        if self.fShard is None:
+            self.open_shard()
+        data = gzip.compress(''.join(self.blockLines).encode('utf-8'))
+        dates = [date for date in self.blockDates if len(date) > 0]
+        self.index['blocks'].append({'offset': self.fShard.tell(),
+                                     'length': len(data),
+                                     'n_posts': len(self.blockLines),
+                                     'date_min': min(dates) if len(dates) > 0 else None,
+                                     'date_max': max(dates) if len(dates) > 0 else None,
+                                     'accounts': sorted(self.blockAccounts)})
+        self.fShard.write(data)
+        self.blockLines = []
+        self.blockBytes = 0
+        self.blockAccounts = set()
+        self.blockDates = []
+        if self.fShard.tell() >= self.shard_bytes:
+            self.close_shard()
+
+    def add_account(self, account, meta, posts):
+        """
+        Add the posts of an account. account is the name of the account
+        in the corpus, meta is its metadata, posts is an iterable of
+        (post ID, post) tuples.
+        """
+        if self.fShard is None:
+            self.open_shard()
+        self.index['accounts'][account] = meta
+        self.index['posts'].setdefault(account, {})
+        for postId, post in posts:
+            if self.fShard is None:
+                self.open_shard()
+            if account not in self.index['accounts']:
+                self.index['accounts'][account] = meta
+                self.index['posts'][account] = {}
+            record = dict(post)
+            record['account'] = account
+            record['id'] = postId
+            line = json.dumps(record, ensure_ascii=False, sort_keys=True) + '\n'
+            self.index['posts'][account][str(postId)] = len(self.index['blocks'])
+            self.blockLines.append(line)
+            self.blockBytes += len(line)
+            self.blockAccounts.add(account)
+            self.blockDates.append(post.get('date', ''))
+            if len(self.blockLines) >= self.block_size or self.blockBytes >= self.block_bytes:
+                self.flush_block()
+
+    def close(self):
+        self.close_shard()
+
+
+class CorpusShard:
+    """
+    A single memory-mapped shard with its index.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename[:-len('.jsonl.gz')] + '.index.json', 'r', encoding='utf-8') as fIndex:
+            self.index = json.load(fIndex)
+        self.fShard = open(filename, 'rb')
+        self.data = b''
+        if os.path.getsize(filename) > 0:
+            self.data = mmap.mmap(self.fShard.fileno(), 0, access=mmap.ACCESS_READ)
+        # The last decompressed block: (block number, posts)
+        self.lastBlock = (None, None)
+
+    def read_block(self, n_block):
+        """
+        Decompress a block and return the list of its posts.
+        """
+        if self.lastBlock[0] == n_block:
+            return self.lastBlock[1]
+        block = self.index['blocks'][n_block]
+        text = zlib.decompress(self.data[block['offset']:block['offset'] + block['length']],
+                               16 + zlib.MAX_WBITS).decode('utf-8')
+        posts = [json.loads(line) for line in text.splitlines()]
+        self.lastBlock = (n_block, posts)
+        return posts
+
+    def block_matches(self, n_block, accounts=None, date_from=None, date_to=None):
+        """
+        Check if a block may contain posts of the accounts written
+        between date_from and date_to, judging by the index only.
+        """
+        block = self.index['blocks'][n_block]
+        if accounts is not None and len(accounts.intersection(block['accounts'])) <= 0:
+            return False
+        if date_from is not None or date_to is not None:
+            if block['date_min'] is None:
+                return False
+            if date_from is not None and block['date_max'] < date_from:
+                return False
+            if date_to is not None and block['date_min'] >= date_to:
+                return False
+        return True
+
+    def close(self):
+        if len(self.data) > 0:
+            self.data.close()
+        self.fShard.close()
+
+
+class CorpusReader:
+    """
+    Read the posts of a corpus written by CorpusWriter. path is either
+    the corpus directory or a single shard. Blocks are only
+    decompressed when posts are requested from them.
+    Dates are strings in the format of the harvested files
+    ("2019-05-01 12:00:00"), or any prefix of it ("2019-05").
+    """
+    def __init__(self, path):
+        if os.path.isdir(path):
+            filenames = sorted(os.path.join(path, fname) for fname in os.listdir(path)
+                               if fname.endswith('.jsonl.gz'))
+        else:
+            filenames = [path]
+        self.shards = [CorpusShard(filename) for filename in filenames]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def accounts(self):
+        """
+        Return a dictionary {account: metadata}.
+        """
+        accounts = {}
+        for shard in self.shards:
+            accounts.update(shard.index['accounts'])
+        return accounts
+
+    def posts(self, accounts=None, date_from=None, date_to=None):
+        """
+        Iterate over the posts of the given accounts (all accounts
+        by default) written on or after date_from and before date_to.
+        """
+        if accounts is not None:
+            accounts = set(accounts)
+        if date_from is not None:
+            date_from = str(date_from)
+        if date_to is not None:
+            date_to = str(date_to)
+        for shard in self.shards:
+            for nBlock in range(len(shard.index['blocks'])):
+                if not shard.block_matches(nBlock, accounts, date_from, date_to):
+                    continue
+                for post in shard.read_block(nBlock):
+                    if accounts is not None and post['account'] not in accounts:
+                        continue
+                    if date_from is not None and not post.get('date', '') >= date_from:
+                        continue
+                    if date_to is not None and not (0 < len(post.get('date', '')) and post['date'] < date_to):
+                        continue
+                    yield post
+
+    def get_post(self, account, post_id):
+        """
+        Return a single post, or None if there is no such post.
+        """
+        for shard in self.shards:
+            nBlock = shard.index['posts'].get(account, {}).get(str(post_id))
+            if nBlock is None:
+                continue
+            for post in shard.read_block(nBlock):
+                if post['account'] == account and str(post['id']) == str(post_id):
+                    return post
+        return None
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+
+def read_dump(filename):
+    """
+    Read a file written by the harvester (JSON or JSON lines) and
+    return the metadata of the account and a dictionary {post ID: post}.
+    In a JSON lines file, the posts after the last metadata record
+    belong to a harvest that has not been finished, so they are left out.
+    If there is no metadata record, the metadata is None.
+    """
+    meta = None
+    posts = {}
+    with open(filename, 'r', encoding='utf-8') as fIn:
+        if filename.endswith('.jsonl'):
+            # If a post was written several times, the last version is the newest one
+            newPosts = {}
+            for line in fIn:
+                line = line.strip()
+                if len(line) <= 0:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line of a file whose harvest was interrupted
+                    continue
+                if record['type'] == 'meta':
+                    meta = record['meta']
+                    posts.update(newPosts)
+                    newPosts = {}
+                elif record['type'] == 'post':
+                    post = dict(record)
+                    del post['type']
+                    del post['id']
+                    newPosts[int(record['id'])] = post
+            if len(newPosts) > 0 and meta is not None:
+                print('Leaving out', len(newPosts), 'posts of an unfinished harvest in', filename)
+        else:
+            data = json.load(fIn)
+            meta = data['meta']
+            posts = {int(postId): post for postId, post in data['posts'].items()}
+    return meta, posts
+
+
+def convert_dumps(lang_dir, out_dir, repost_store=None, **kwargs):
+    """
+    Convert all account files in lang_dir and lang_dir/users to a corpus
+    in out_dir. If the posts contain references to a RepostStore, pass
+    the store to put the reposted texts back. Other keyword arguments
+    are passed to CorpusWriter.
+    """
+    writer = CorpusWriter(out_dir, **kwargs)
+    nAccounts = nPosts = 0
+    for subdir in ['', 'users']:
+        path = os.path.join(lang_dir, subdir)
+        if not os.path.isdir(path):
+            continue
+        for fname in sorted(os.listdir(path)):
+            if fname.endswith('.state.json') or fname == 'manifest.json':
+                continue
+            if not fname.endswith('.json') and not fname.endswith('.jsonl'):
+                continue
+            meta, posts = read_dump(os.path.join(path, fname))
+            if meta is None:
+                print('Skipping incomplete file', os.path.join(path, fname))
+                continue
+            if repost_store is not None:
+                repost_store.resolve_posts(posts)
+            account = os.path.splitext(fname)[0]
+            if len(subdir) > 0:
+                account = subdir + '/' + account
+            writer.add_account(account, meta, ((postId, posts[postId]) for postId in sorted(posts)))
+            nAccounts += 1
+            nPosts += len(posts)
+    writer.close()
+    print('Converted', nPosts, 'posts of', nAccounts, 'accounts to', out_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert the files written by VkHarvester to a compressed corpus.')
+    parser.add_argument('lang_dir', help='directory with the harvested files')
+    parser.add_argument('out_dir', help='directory for the corpus shards')
+    parser.add_argument('--reposts', help='reposts.jsonl written by RepostStore, if it was used')
+    parser.add_argument('--block-size', type=int, default=1000, help='posts per compressed block')
+    args = parser.parse_args()
+    repostStore = None
+    if args.reposts is not None:
+        import vk_harvester
+        repostStore = vk_harvester.RepostStore(args.reposts)
+    convert_dumps(args.lang_dir, args.out_dir, repost_store=repostStore, block_size=args.block_size)
+    if repostStore is not None:
+        repostStore.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,47 +1,586 @@
-import urllib.request as requests
 import urllib.parse as parse
+import http.client
+import gzip
+import zlib
+import random
 import re
 import datetime
 import json
 import os
 import time
 import copy
+import collections
+import threading
+import queue
+import traceback
+import sqlite3
+import socket
+import contextlib
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
 
 
-class VkHarvester:
+class RateLimiter:
     """
-    Class with methods for harvesting linguictic data and metadata
-    from vk.com using their API.
+    Token bucket that keeps the request rate of one access token
+    within the API limits. The bucket holds rate tokens, and each token
+    is returned period seconds after the request that used it was
+    actually sent, so the harvester only sleeps for what is left
+    of the current window instead of a fixed time before every request.
+    If rate is not a whole number, it is rounded down, since the limits
+    count whole requests per window, e.g. rate=2.5 means 2 requests per
+    period. A rate below 1 stretches the window instead: rate=0.5 means
+    1 request per 2 periods.
+    clock and sleep can be replaced, e.g. with a fake clock in tests.
     """
-    rxVkId = re.compile('\\[((?:id|club)[0-9]+)\\|([^\r\n\\[\\]]+)\\]')
+    # "Too many requests per second"
+    ERR_TOO_MANY_REQUESTS = 6
+    # "Flood control" and "Rate limit reached"
+    ERR_FLOOD_CONTROL = (9, 29)
 
-    def __init__(self, lang):
-        self.lang = lang
-        # In order to use the vk API, you have to register your own
-        # app and get an acces token. The token should be stored in
-        # config.txt as plain text.
+    def __init__(self, rate=3, period=1.05, flood_pause=60.0, max_pause=600.0,
+                 clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError('The request rate must be positive.')
+        self.rate = rate
+        self.period = period
+        self.capacity = max(1, int(rate))
+        self.window = period * max(1.0, 1.0 / rate)
+        self.flood_pause = flood_pause
+        self.max_pause = max_pause
+        self.clock = clock
+        self.sleep = sleep
+        self.sendTimes = collections.deque()
+        self.pausedUntil = 0.0
+        self.nBackoffs = 0
+        self.sleepTime = 0.0
+        self.lock = threading.Lock()
+
+    def delay(self):
+        """
+        Return the number of seconds to wait before the next request
+        may be sent.
+        """
+        now = self.clock()
+        delay = self.pausedUntil - now
+        if len(self.sendTimes) >= self.capacity:
+            delay = max(delay, self.sendTimes[0] + self.window - now)
+        return max(delay, 0.0)
+
+    def wait(self):
+        """
+        Block until a token is available and take it.
+        """
+        with self.lock:
+            delay = self.delay()
+            if delay > 0:
+                self.sleep(delay)
+                self.sleepTime += delay
+            self.sendTimes.append(self.clock())
+            while len(self.sendTimes) > self.capacity:
+                self.sendTimes.popleft()
+
+    def pause(self, seconds):
+        """
+        Do not send any requests for the given number of seconds.
+        """
+        with self.lock:
+            self.pausedUntil = max(self.pausedUntil, self.clock() + seconds)
+
+    def success(self):
+        """
+        Register a request that was not rejected by the rate limits.
+        """
+        self.nBackoffs = 0
+
+    def backoff(self, error_code):
+        """
+        Pause all requests after the API has rejected one of them
+        because of the rate limits. Each consecutive rejection doubles
+        the pause. Return False if the error has nothing to do with
+        the rate limits.
+        """
+        if error_code == self.ERR_TOO_MANY_REQUESTS:
+            pause = self.period
+        elif error_code in self.ERR_FLOOD_CONTROL:
+            pause = self.flood_pause
+        else:
+            return False
+        with self.lock:
+            pause = min(pause * 2 ** self.nBackoffs, self.max_pause)
+            self.nBackoffs += 1
+            self.pausedUntil = max(self.pausedUntil, self.clock() + pause)
+        print('Rate limit exceeded (error ' + str(error_code) + '), pausing for', round(pause, 2), 's.')
+        return True
+
+
+class BatchSizeController:
+    """
+    Choose the number of API calls packed into one execute request.
+    After each successful request the batch grows by one call (up to
+    max_size); after a failure, or if the response was too large or
+    too slow, it is halved. The caller repeats a failed request at the
+    same offset with the new size.
+    """
+    def __init__(self, max_size=25, min_size=1, max_bytes=4000000, max_latency=15.0, max_failures=5):
+        self.max_size = max_size
+        self.min_size = min_size
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+        self.max_failures = max_failures
+        self.size = max_size
+        self.nFailures = 0
+
+    def success(self, n_bytes=0, latency=0.0):
+        """
+        Register a successful request that took latency seconds
+        and returned n_bytes bytes.
+        """
+        self.nFailures = 0
+        if n_bytes > self.max_bytes or latency > self.max_latency:
+            self.size = max(self.min_size, self.size // 2)
+        else:
+            self.size = min(self.max_size, self.size + 1)
+
+    def failure(self):
+        """
+        Register a failed request. Return False if the requests keep
+        failing even with the smallest batch size, so that it makes no
+        sense to try again. In this case, the failure count starts anew
+        for whatever the caller does next.
+        """
+        self.nFailures += 1
+        self.size = max(self.min_size, self.size // 2)
+        if self.size <= self.min_size and self.nFailures >= self.max_failures:
+            self.nFailures = 0
+            return False
+        return True
+
+
+class HarvestPipeline:
+    """
+    A chain of stages, each running in its own thread. The stages are
+    connected by bounded queues: stages is a list of (name, function)
+    tuples, and each function takes an item from its queue and returns
+    the item for the next stage (None means nothing to pass on). When
+    a queue is full, the stage before it waits, so that a slow stage
+    holds back the whole pipeline. on_start and on_stop, if given, are
+    called in each stage thread before and after it processes items.
+    If a stage fails, the pipeline is marked as failed and the remaining
+    items are dropped.
+    """
+    def __init__(self, stages, queue_size=4, on_start=None, on_stop=None):
+        self.names = [name for name, function in stages]
+        self.functions = [function for name, function in stages]
+        self.queues = [queue.Queue(maxsize=queue_size) for i in range(len(stages))]
+        self.on_start = on_start
+        self.on_stop = on_stop
+        self.failed = False
+        self.threads = [threading.Thread(target=self.run_stage, args=(i,), daemon=True)
+                        for i in range(len(stages))]
+        for thread in self.threads:
+            thread.start()
+
+    def run_stage(self, i_stage):
+        started = False
         try:
-            with open('config.txt', 'r', encoding='utf-8') as fAccessToken:
-                self.access_token = fAccessToken.read()
-                if '\n' in self.access_token:
-                    self.access_token = re.sub('\n.*', '', self.access_token, flags=re.DOTALL)
-        except OSError:
-            print('Could not load the access token.')
-            self.access_token = ''
-        self.urls = self.get_urls()
-        self.request_count = 0
-        self.n_batch_calls = 25
+            try:
+                if self.on_start is not None:
+                    self.on_start()
+                started = True
+            except Exception:
+                print('Could not start the', self.names[i_stage], 'stage:')
+                traceback.print_exc()
+                self.failed = True
+            # Even if the stage has failed, its queue is emptied until the end,
+            # so that the stages before it are not blocked.
+            while True:
+                item = self.queues[i_stage].get()
+                if item is None:
+                    break
+                if self.failed:
+                    continue
+                try:
+                    result = self.functions[i_stage](item)
+                except Exception:
+                    print('Error in the', self.names[i_stage], 'stage:')
+                    traceback.print_exc()
+                    self.failed = True
+                    continue
+                if result is not None and i_stage + 1 < len(self.queues):
+                    self.queues[i_stage + 1].put(result)
+        finally:
+            if i_stage + 1 < len(self.queues):
+                self.queues[i_stage + 1].put(None)
+            if started and self.on_stop is not None:
+                self.on_stop()
+
+    def put(self, item):
+        """
+        Pass an item to the first stage, waiting if its queue is full.
+        """
+        self.queues[0].put(item)
+
+    def queue_depths(self):
+        """
+        Return the number of items waiting in front of each stage.
+        """
+        return {self.names[i]: self.queues[i].qsize() for i in range(len(self.queues))}
+
+    def close(self):
+        """
+        Wait until all items have passed through the pipeline and
+        stop the threads. Return False if any stage has failed.
+        """
+        self.queues[0].put(None)
+        for thread in self.threads:
+            thread.join()
+        return not self.failed
+
+
+class HarvestStats:
+    """
+    Counters and timers for a long harvest: calls, errors, latency
+    histograms and bytes received for each API method, time spent in
+    different parts of the harvester (rate limit sleeps, JSON decoding,
+    comment downloading, output etc.), cache hits and the number
+    of harvested posts and comments. snapshot() returns the current
+    values; start_export() writes them to a file periodically.
+    """
+    latency_buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.timeStart = clock()
+        self.lock = threading.Lock()
+        self.methods = {}
+        self.counters = collections.Counter()
+        self.timers = collections.Counter()
+        self.exportThread = None
+        self.exportStop = threading.Event()
+
+    def record_request(self, method, latency, n_bytes=0, error=None):
+        """
+        Register one HTTP request to an API method. n_bytes is the size
+        of the response as received over the network (compressed). error is
+        an error code or a short error description, if the request failed.
+        """
+        with self.lock:
+            if method not in self.methods:
+                self.methods[method] = {'calls': 0, 'errors': {}, 'bytes': 0, 'latency_sum': 0.0,
+                                        'latency_buckets': [0] * (len(self.latency_buckets) + 1)}
+            methodStats = self.methods[method]
+            methodStats['calls'] += 1
+            methodStats['bytes'] += n_bytes
+            methodStats['latency_sum'] += latency
+            iBucket = 0
+            while iBucket < len(self.latency_buckets) and latency > self.latency_buckets[iBucket]:
+                iBucket += 1
+            methodStats['latency_buckets'][iBucket] += 1
+            if error is not None:
+                methodStats['errors'][str(error)] = methodStats['errors'].get(str(error), 0) + 1
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.timers[name] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """
+        Context manager that adds the time spent inside it to the timer name.
+        """
+        timeStart = self.clock()
+        try:
+            yield
+        finally:
+            self.add_time(name, self.clock() - timeStart)
+
+    def snapshot(self):
+        """
+        Return a dictionary with the current values of all metrics.
+        """
+        with self.lock:
+            elapsed = max(self.clock() - self.timeStart, 1e-9)
+            cacheLookups = self.counters['author_cache_hits'] + self.counters['author_cache_misses']
+            return {'time': str(datetime.datetime.now()),
+                    'elapsed_s': round(elapsed, 3),
+                    'counters': dict(self.counters),
+                    'timers_s': {k: round(v, 3) for k, v in self.timers.items()},
+                    'methods': copy.deepcopy(self.methods),
+                    'latency_buckets': list(self.latency_buckets),
+                    'requests_per_s': round(sum(m['calls'] for m in self.methods.values()) / elapsed, 3),
+                    'posts_per_s': round(self.counters['posts'] / elapsed, 3),
+                    'comments_per_s': round(self.counters['comments'] / elapsed, 3),
+                    'author_cache_hit_ratio': round(self.counters['author_cache_hits'] / cacheLookups, 4)
+                                              if cacheLookups > 0 else None}
+
+    def to_prometheus(self):
+        """
+        Return the metrics in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for name in sorted(snapshot['counters']):
+            lines.append('vk_harvester_' + name + '_total ' + str(snapshot['counters'][name]))
+        for name in sorted(snapshot['timers_s']):
+            lines.append('vk_harvester_' + name + '_seconds_total ' + str(snapshot['timers_s'][name]))
+        for method in sorted(snapshot['methods']):
+            methodStats = snapshot['methods'][method]
+            label = 'method="' + method + '"'
+            lines.append('vk_harvester_requests_total{' + label + '} ' + str(methodStats['calls']))
+            lines.append('vk_harvester_response_bytes_total{' + label + '} ' + str(methodStats['bytes']))
+            for error in sorted(methodStats['errors']):
+                lines.append('vk_harvester_request_errors_total{' + label + ',error="' + error + '"} ' +
+                             str(methodStats['errors'][error]))
+            nCumulative = 0
+            for bound, n in zip(list(self.latency_buckets) + ['+Inf'], methodStats['latency_buckets']):
+                nCumulative += n
+                lines.append('vk_harvester_request_latency_seconds_bucket{' + label + ',le="' + str(bound) + '"} ' +
+                             str(nCumulative))
+            lines.append('vk_harvester_request_latency_seconds_sum{' + label + '} ' +
+                         str(round(methodStats['latency_sum'], 6)))
+            lines.append('vk_harvester_request_latency_seconds_count{' + label + '} ' + str(methodStats['calls']))
+        return '\n'.join(lines) + '\n'
+
+    def export(self, fname, metrics_format='jsonl'):
+        """
+        Write the current metrics to a file: append a JSON line, or
+        replace the file with the Prometheus text format.
+        """
+        if metrics_format == 'prometheus':
+            with open(fname + '.tmp', 'w', encoding='utf-8') as fOut:
+                fOut.write(self.to_prometheus())
+            os.replace(fname + '.tmp', fname)
+        else:
+            with open(fname, 'a', encoding='utf-8') as fOut:
+                fOut.write(json.dumps(self.snapshot(), sort_keys=True) + '\n')
+
+    def start_export(self, fname, interval=60, metrics_format='jsonl'):
+        """
+        Export the metrics every interval seconds in a background thread.
+        """
+        self.stop_export()
+        self.exportStop.clear()
+
+        def export_loop():
+            while not self.exportStop.wait(interval):
+                self.export(fname, metrics_format)
+            self.export(fname, metrics_format)
+
+        self.exportThread = threading.Thread(target=export_loop, daemon=True)
+        self.exportThread.start()
+
+    def stop_export(self):
+        """
+        Stop the periodic export, writing the metrics one last time.
+        """
+        if self.exportThread is not None:
+            self.exportStop.set()
+            self.exportThread.join()
+            self.exportThread = None
+
+
+class HttpError(Exception):
+    """
+    The server answered with an HTTP error status.
+    """
+    def __init__(self, status, reason=''):
+        Exception.__init__(self, 'HTTP ' + str(status) + ' ' + reason)
+        self.status = status
+
+
+class ContentDecodingError(ValueError):
+    """
+    The body of the response could not be decompressed, e.g. because
+    it was truncated.
+    """
+    pass
+
+
+class HttpSession:
+    """
+    Keep-alive connection to one HTTP(S) server. Responses are requested
+    in gzip. Queries that are too long for a GET request, such as long
+    execute scripts, are sent as POST.
+    """
+    def __init__(self, timeout=60, max_get_length=2048):
+        self.timeout = timeout
+        self.max_get_length = max_get_length
+        self.connection = None
+        self.host = None
+        self.lock = threading.Lock()
+
+    def connect(self, scheme, host):
+        if self.connection is not None and self.host == (scheme, host):
+            return self.connection
+        self.close()
+        if scheme == 'https':
+            self.connection = http.client.HTTPSConnection(host, timeout=self.timeout)
+        else:
+            self.connection = http.client.HTTPConnection(host, timeout=self.timeout)
+        self.host = (scheme, host)
+        return self.connection
+
+    def request(self, url, params):
+        """
+        Send the query and return a tuple (body of the response as bytes,
+        size of the body as it was transferred, i.e. before it was
+        decompressed). Raise HttpError if the response has an error status, OSError or
+        http.client.HTTPException if the connection failed, or
+        ContentDecodingError if the compressed body was broken.
+        """
+        urlParts = parse.urlsplit(url)
+        query = parse.urlencode(params)
+        headers = {'Accept-Encoding': 'gzip', 'Connection': 'keep-alive'}
+        with self.lock:
+            connection = self.connect(urlParts.scheme, urlParts.netloc)
+            try:
+                if len(urlParts.path) + len(query) + 1 > self.max_get_length:
+                    headers['Content-Type'] = 'application/x-www-form-urlencoded'
+                    connection.request('POST', urlParts.path, body=query.encode('utf-8'), headers=headers)
+                else:
+                    connection.request('GET', urlParts.path + '?' + query, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException):
+                # The connection cannot be reused after a failure.
+                self.close()
+                raise
+            if response.getheader('Connection', '').lower() == 'close':
+                self.close()
+        nWireBytes = len(body)
+        if response.getheader('Content-Encoding', '').lower() == 'gzip':
+            try:
+                body = gzip.decompress(body)
+            except (EOFError, OSError, zlib.error) as err:
+                with self.lock:
+                    self.close()
+                raise ContentDecodingError('Could not decompress the response: ' + repr(err))
+        if response.status >= 400:
+            raise HttpError(response.status, response.reason)
+        return body, nWireBytes
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+        self.connection = None
+        self.host = None
+
+
+class AuthorRecord:
+    """
+    Compact in-memory description of a user who wrote posts or comments.
+    Only the fields that end up in the harvested files are stored in
+    slots. The remaining fields of a full profile, if it was downloaded,
+    are kept in extra; for the authors downloaded with the short field
+    list, extra is None. The essential view used in the output is built
+    once and then reused.
+    """
+    __slots__ = ('id', 'first_name', 'last_name', 'sex', 'city', 'bdate', 'home_town', 'extra', 'essential_view')
+    # Fields to request from users.get when only the essential data is needed
+    short_fields = 'sex, bdate, city, home_town'
+    slot_fields = ('id', 'first_name', 'last_name', 'sex', 'bdate', 'home_town')
+
+    def __init__(self, user_id, first_name=None, last_name=None, sex=None,
+                 city=None, bdate=None, home_town=None, extra=None):
+        self.id = user_id
+        self.first_name = first_name
+        self.last_name = last_name
+        self.sex = sex
+        self.city = city
+        self.bdate = bdate
+        self.home_town = home_town
+        self.extra = extra
+        self.essential_view = None
+
+    @classmethod
+    def from_dict(cls, user, keep_extra=True):
+        """
+        Make a record from a user dictionary returned by users.get.
+        If keep_extra is False, drop all non-essential fields.
+        """
+        if isinstance(user, cls):
+            return user
+        city = None
+        if 'city' in user and type(user['city']) == dict:
+            city = user['city'].get('title')
+        extra = None
+        if keep_extra:
+            extra = {k: v for k, v in user.items() if k not in cls.slot_fields}
+            if len(extra) <= 0:
+                extra = None
+        return cls(user['id'], user.get('first_name'), user.get('last_name'), user.get('sex'),
+                   city, user.get('bdate'), user.get('home_town'), extra)
+
+    def to_dict(self):
+        """
+        Return the user as a dictionary in the format of users.get.
+        """
+        user = {}
+        if self.extra is not None:
+            user.update(self.extra)
+        user['id'] = self.id
+        for field in self.slot_fields[1:]:
+            if getattr(self, field) is not None:
+                user[field] = getattr(self, field)
+        if self.city is not None and 'city' not in user:
+            user['city'] = {'title': self.city}
+        return user
+
+    def essential(self):
+        """
+        Return a shortened dictionary describing the user, only with
+        the keys that need to be saved in json files. The same dictionary
+        is returned each time, so it should not be changed.
+        """
+        if self.essential_view is None:
+            essentialView = {'id': self.id, 'first_name': self.first_name,
+                             'last_name': self.last_name, 'sex': self.sex}
+            if self.city is not None:
+                essentialView['city'] = self.city
+            if self.bdate is not None:
+                essentialView['bdate'] = self.bdate
+            if self.home_town is not None:
+                essentialView['home_town'] = self.home_town
+            self.essential_view = essentialView
+        return self.essential_view
+
+
+def author_to_json(obj):
+    """
+    Serialize AuthorRecord objects with json.dump(s).
+    """
+    if isinstance(obj, AuthorRecord):
+        return obj.to_dict()
+    raise TypeError('Object of type ' + type(obj).__name__ + ' is not JSON serializable')
+
+
+class JsonMetadataStore:
+    """
+    Store user metadata and the texts of user mentions in memory and
+    write them to userData.json and userMentions.json. userMetadata
+    is a dictionary {user ID: AuthorRecord}, userMentions is a dictionary
+    {user or group ID: set of mention texts}.
+    """
+    def __init__(self, fname_mentions='userMentions.json', fname_userdata='userData.json'):
+        self.fname_mentions = fname_mentions
+        self.fname_userdata = fname_userdata
+        self.lock = threading.RLock()
         # Each time a user or a group is mentioned, the text of
         # the mention is stored in userMentions.json. This information
         # is not important for the processing, so if you do not need
         # this, you can safely switch this off.
         try:
-            with open('userMentions.json', 'r', encoding='utf-8') as fVkDescs:
+            with open(fname_mentions, 'r', encoding='utf-8') as fVkDescs:
                 self.userMentions = json.loads(fVkDescs.read())
         except FileNotFoundError:
             print('Warning: could not load vk user descriptions.')
             self.userMentions = {}
-            fEmpty = open('userMentions.json', 'w', encoding='utf-8')
+            fEmpty = open(fname_mentions, 'w', encoding='utf-8')
             fEmpty.write('{}')
             fEmpty.close()
         for k in self.userMentions:
@@ -49,15 +588,868 @@ class VkHarvester:
         # User metadata is stored in userData.json. For each user,
         # the metadata is only loaded once.
         try:
-            with open('userData.json', 'r', encoding='utf-8') as fVkData:
-                self.userMetadata = json.loads(fVkData.read())
+            with open(fname_userdata, 'r', encoding='utf-8') as fVkData:
+                self.userMetadata = {userId: AuthorRecord.from_dict(user)
+                                     for userId, user in json.loads(fVkData.read()).items()}
         except FileNotFoundError:
             print('Warning: could not load vk user data.')
             self.userMetadata = {}
-            fEmpty = open('userData.json', 'w', encoding='utf-8')
+            fEmpty = open(fname_userdata, 'w', encoding='utf-8')
             fEmpty.write('{}')
             fEmpty.close()
 
+    def add_mentions(self, mentions):
+        """
+        Add a list of (ID, mention text) pairs.
+        """
+        with self.lock:
+            for userId, text in mentions:
+                if userId not in self.userMentions:
+                    self.userMentions[userId] = set()
+                self.userMentions[userId].add(text)
+
+    def save(self):
+        """
+        Write the data to the JSON files.
+        """
+        self.export_json(self.fname_mentions, self.fname_userdata)
+
+    def export_json(self, fname_mentions, fname_userdata):
+        """
+        Write the data to the JSON files with the given names.
+        """
+        with self.lock:
+            jsonVkMentions = json.dumps({k: sorted(v) for k, v in self.userMentions.items()},
+                                        ensure_ascii=False,
+                                        indent=2,
+                                        sort_keys=True)
+            jsonVkData = json.dumps(self.userMetadata,
+                                    ensure_ascii=False,
+                                    indent=2,
+                                    sort_keys=True,
+                                    default=author_to_json)
+            with open(fname_mentions, 'w', encoding='utf-8') as fVkDesc:
+                fVkDesc.write(jsonVkMentions)
+            with open(fname_userdata, 'w', encoding='utf-8') as fVkData:
+                fVkData.write(jsonVkData)
+
+    def close(self):
+        self.save()
+
+
+class SqliteUserMetadata(MutableMapping):
+    """
+    Dictionary-like view {user ID: AuthorRecord} of the users table
+    of an SQLite metadata store. The most recently used records are
+    cached in memory.
+    """
+    def __init__(self, store, cache_size=100000):
+        self.store = store
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+
+    def __getitem__(self, userId):
+        userId = str(userId)
+        with self.store.lock:
+            if userId in self.cache:
+                self.cache.move_to_end(userId)
+                return self.cache[userId]
+            if userId in self.store.pendingUsers:
+                return self.store.pendingUsers[userId]
+            row = self.store.db.execute('SELECT data FROM users WHERE id = ?', (userId,)).fetchone()
+            if row is None:
+                raise KeyError(userId)
+            user = AuthorRecord.from_dict(json.loads(row[0]))
+            self.cache[userId] = user
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return user
+
+    def __setitem__(self, userId, user):
+        self.store.add_users({str(userId): user})
+
+    def __delitem__(self, userId):
+        userId = str(userId)
+        with self.store.lock:
+            self.store.flush()
+            self.cache.pop(userId, None)
+            if self.store.db.execute('DELETE FROM users WHERE id = ?', (userId,)).rowcount <= 0:
+                raise KeyError(userId)
+
+    def __contains__(self, userId):
+        userId = str(userId)
+        with self.store.lock:
+            if userId in self.cache or userId in self.store.pendingUsers:
+                return True
+            return self.store.db.execute('SELECT 1 FROM users WHERE id = ?', (userId,)).fetchone() is not None
+
+    def __iter__(self):
+        with self.store.lock:
+            self.store.flush()
+            userIds = [row[0] for row in self.store.db.execute('SELECT id FROM users ORDER BY id')]
+        return iter(userIds)
+
+    def __len__(self):
+        with self.store.lock:
+            self.store.flush()
+            return self.store.db.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+
+class SqliteUserMentions(MutableMapping):
+    """
+    Dictionary-like view {user or group ID: set of mention texts} of
+    the mentions table of an SQLite metadata store. The sets it returns
+    are copies; use add_mentions() of the store to add new mentions.
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, userId):
+        with self.store.lock:
+            self.store.flush()
+            texts = set(row[0] for row in
+                        self.store.db.execute('SELECT text FROM mentions WHERE id = ?', (userId,)))
+        if len(texts) <= 0:
+            raise KeyError(userId)
+        return texts
+
+    def __setitem__(self, userId, texts):
+        self.store.add_mentions([(userId, text) for text in texts])
+
+    def __delitem__(self, userId):
+        with self.store.lock:
+            self.store.flush()
+            if self.store.db.execute('DELETE FROM mentions WHERE id = ?', (userId,)).rowcount <= 0:
+                raise KeyError(userId)
+
+    def __iter__(self):
+        with self.store.lock:
+            self.store.flush()
+            userIds = [row[0] for row in self.store.db.execute('SELECT DISTINCT id FROM mentions ORDER BY id')]
+        return iter(userIds)
+
+    def __len__(self):
+        with self.store.lock:
+            self.store.flush()
+            return self.store.db.execute('SELECT COUNT(DISTINCT id) FROM mentions').fetchone()[0]
+
+
+class SqliteMetadataStore:
+    """
+    Store user metadata and the texts of user mentions in an SQLite
+    database instead of the JSON files, so that they do not have to be
+    kept in memory and rewritten in full after each account. New data
+    is accumulated and written in batched transactions. userMetadata and
+    userMentions behave like the dictionaries of JsonMetadataStore.
+    """
+    def __init__(self, fname='userData.sqlite', batch_size=1000):
+        self.fname = fname
+        self.batch_size = batch_size
+        self.lock = threading.RLock()
+        self.pendingUsers = {}
+        self.pendingMentions = set()
+        self.db = sqlite3.connect(fname, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS users '
+                        '(id TEXT PRIMARY KEY, data TEXT NOT NULL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS mentions '
+                        '(id TEXT NOT NULL, text TEXT NOT NULL, PRIMARY KEY (id, text)) WITHOUT ROWID')
+        self.db.commit()
+        self.userMetadata = SqliteUserMetadata(self)
+        self.userMentions = SqliteUserMentions(self)
+
+    def add_users(self, users):
+        """
+        Add or replace the data for users in a dictionary {user ID: user data}.
+        """
+        with self.lock:
+            for userId, user in users.items():
+                self.pendingUsers[str(userId)] = AuthorRecord.from_dict(user)
+                self.userMetadata.cache.pop(str(userId), None)
+            if len(self.pendingUsers) >= self.batch_size:
+                self.flush()
+
+    def add_mentions(self, mentions):
+        """
+        Add a list of (ID, mention text) pairs.
+        """
+        with self.lock:
+            self.pendingMentions.update(mentions)
+            if len(self.pendingMentions) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        """
+        Write all pending data to the database in one transaction.
+        """
+        with self.lock:
+            if len(self.pendingUsers) <= 0 and len(self.pendingMentions) <= 0:
+                return
+            with self.db:
+                self.db.executemany('INSERT INTO users (id, data) VALUES (?, ?) '
+                                    'ON CONFLICT (id) DO UPDATE SET data = excluded.data',
+                                    [(userId, json.dumps(user, ensure_ascii=False, sort_keys=True,
+                                                         default=author_to_json))
+                                     for userId, user in self.pendingUsers.items()])
+                self.db.executemany('INSERT OR IGNORE INTO mentions (id, text) VALUES (?, ?)',
+                                    sorted(self.pendingMentions))
+            self.pendingUsers = {}
+            self.pendingMentions = set()
+
+    def save(self):
+        self.flush()
+
+    def import_json(self, fname_mentions='userMentions.json', fname_userdata='userData.json'):
+        """
+        Add the data from the JSON files written by JsonMetadataStore.
+        This only has to be done once, when switching to SQLite.
+        """
+        with open(fname_userdata, 'r', encoding='utf-8') as fVkData:
+            userMetadata = json.load(fVkData)
+        with self.lock:
+            for userId in userMetadata:
+                self.pendingUsers[str(userId)] = AuthorRecord.from_dict(userMetadata[userId])
+            userMetadata = None
+            with open(fname_mentions, 'r', encoding='utf-8') as fVkDescs:
+                userMentions = json.load(fVkDescs)
+            for userId in userMentions:
+                self.pendingMentions.update((userId, text) for text in userMentions[userId])
+            self.flush()
+        print('Imported user data from', fname_userdata, 'and', fname_mentions)
+
+    def export_json(self, fname_mentions='userMentions.json', fname_userdata='userData.json'):
+        """
+        Write the data to JSON files in the format used by JsonMetadataStore.
+        The files are written row by row, so the data is never loaded
+        into memory at once.
+        """
+        with self.lock:
+            self.flush()
+            with open(fname_userdata, 'w', encoding='utf-8') as fVkData:
+                fVkData.write('{')
+                nRows = 0
+                for userId, data in self.db.execute('SELECT id, data FROM users ORDER BY id'):
+                    if nRows > 0:
+                        fVkData.write(',')
+                    fVkData.write('\n  ' + json.dumps(userId) + ': ' +
+                                  json.dumps(json.loads(data), ensure_ascii=False,
+                                             indent=2, sort_keys=True).replace('\n', '\n  '))
+                    nRows += 1
+                fVkData.write('\n}' if nRows > 0 else '}')
+            with open(fname_mentions, 'w', encoding='utf-8') as fVkDesc:
+                fVkDesc.write('{')
+                prevId = None
+                for userId, text in self.db.execute('SELECT id, text FROM mentions ORDER BY id, text'):
+                    if userId != prevId:
+                        if prevId is not None:
+                            fVkDesc.write('\n  ],')
+                        fVkDesc.write('\n  ' + json.dumps(userId) + ': [')
+                    else:
+                        fVkDesc.write(',')
+                    fVkDesc.write('\n    ' + json.dumps(text, ensure_ascii=False))
+                    prevId = userId
+                fVkDesc.write('\n  ]\n}' if prevId is not None else '}')
+        print('Exported user data to', fname_userdata, 'and', fname_mentions)
+
+    def merge(self, fname):
+        """
+        Add the data from another SQLite metadata database, e.g. one
+        written by another worker of a distributed harvest. If both
+        have data for a user, the record with more fields is kept, so that
+        a full profile is not replaced by the short one of an author.
+        """
+        with self.lock:
+            self.flush()
+            self.db.create_function('n_fields', 1, lambda data: len(json.loads(data)))
+            self.db.execute('ATTACH DATABASE ? AS other', (fname,))
+            try:
+                with self.db:
+                    self.db.execute('INSERT INTO users (id, data) SELECT id, data FROM other.users WHERE true '
+                                    'ON CONFLICT (id) DO UPDATE SET data = excluded.data '
+                                    'WHERE n_fields(excluded.data) > n_fields(users.data)')
+                    self.db.execute('INSERT OR IGNORE INTO mentions (id, text) SELECT id, text FROM other.mentions')
+            finally:
+                self.db.execute('DETACH DATABASE other')
+            self.userMetadata.cache.clear()
+        print('Merged user data from', fname)
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.db.close()
+
+
+class RepostStore:
+    """
+    Append-only store of the texts of reposted messages, shared by all
+    accounts and harvests. Each text is kept once under the key
+    "<post_src_owner>_<copy_id>" in a JSON lines file. When it is used,
+    the posts only contain the key of the reposted text (copy_ref)
+    instead of the text itself (copy_text). The positions of the records
+    in the file are indexed in memory, so that the texts can be read back
+    by resolve_posts().
+    The index is only built when the store is opened, so a file must not
+    be written by several processes at once. In a distributed harvest
+    (see VkHarvester.harvest_queue), each process should have its own
+    store; the stores can be merged afterwards (see merge).
+    """
+    def __init__(self, fname='reposts.jsonl'):
+        self.fname = fname
+        self.lock = threading.RLock()
+        # {key: offset of the record in the file}
+        self.index = {}
+        self.load_index()
+        self.fOut = open(self.fname, 'ab')
+        self.fIn = open(self.fname, 'rb')
+
+    @staticmethod
+    def make_key(owner_id, post_id):
+        return str(owner_id) + '_' + str(post_id)
+
+    def load_index(self):
+        """
+        Read the offsets of all records in an existing file.
+        """
+        if not os.path.exists(self.fname):
+            return
+        offset = 0
+        with open(self.fname, 'rb') as fIn:
+            for line in fIn:
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                    self.index[record['key']] = offset
+                except (ValueError, KeyError):
+                    print('Skipping a broken line in', self.fname, 'at offset', offset)
+                offset += len(line)
+            if offset > 0 and not line.endswith(b'\n'):
+                # The last record was not written completely
+                with open(self.fname, 'ab') as fOut:
+                    fOut.write(b'\n')
+
+    def add(self, owner_id, post_id, text):
+        """
+        Store the text of a reposted message if it is not in the store yet.
+        Return its key and True if the text is new, False otherwise.
+        """
+        key = self.make_key(owner_id, post_id)
+        with self.lock:
+            if key in self.index:
+                return key, False
+            line = json.dumps({'key': key, 'text': text}, ensure_ascii=False) + '\n'
+            self.fOut.seek(0, os.SEEK_END)
+            self.index[key] = self.fOut.tell()
+            self.fOut.write(line.encode('utf-8'))
+            self.fOut.flush()
+        return key, True
+
+    def merge(self, fname):
+        """
+        Add the texts from another store file (e.g. one written by another
+        worker of a distributed harvest) whose keys are not in this store yet.
+        Return the number of texts added.
+        """
+        nAdded = 0
+        with open(fname, 'rb') as fIn:
+            for line in fIn:
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                    key, text = record['key'], record['text']
+                except (ValueError, KeyError):
+                    continue
+                with self.lock:
+                    if key in self.index:
+                        continue
+                    line = json.dumps({'key': key, 'text': text}, ensure_ascii=False) + '\n'
+                    self.fOut.seek(0, os.SEEK_END)
+                    self.index[key] = self.fOut.tell()
+                    self.fOut.write(line.encode('utf-8'))
+                nAdded += 1
+        self.fOut.flush()
+        print('Merged', nAdded, 'reposted texts from', fname)
+        return nAdded
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def get(self, key):
+        """
+        Return the text stored under the key, or None if there is no such key.
+        """
+        with self.lock:
+            if key not in self.index:
+                return None
+            self.fIn.seek(self.index[key])
+            line = self.fIn.readline()
+        return json.loads(line.decode('utf-8'))['text']
+
+    def resolve_posts(self, posts):
+        """
+        Replace the references to reposted texts in posts (a dictionary
+        {post ID: post}, as in the harvested files, or a list of posts)
+        with the texts themselves. The posts are changed in place.
+        """
+        if type(posts) == dict:
+            posts = posts.values()
+        for post in posts:
+            if 'copy_ref' not in post:
+                continue
+            text = self.get(post['copy_ref'])
+            if text is None:
+                print('Reposted text', post['copy_ref'], 'not found.')
+                continue
+            post['copy_text'] = text
+            del post['copy_ref']
+
+    def close(self):
+        with self.lock:
+            self.fOut.close()
+            self.fIn.close()
+
+
+class WorkQueue:
+    """
+    Queue of accounts to harvest, shared by several processes, possibly
+    on different machines, through an SQLite database on a shared file
+    system. A worker leases an account for lease_time seconds and has to
+    renew the lease (see start_heartbeat) until it marks the account
+    as done. The accounts whose leases have expired, e.g. because the
+    worker died, are given to other workers. An account that has failed
+    max_attempts times is not given out any more.
+    Since the clocks of different machines are compared, they should
+    be synchronized with much better precision than lease_time.
+    """
+    def __init__(self, fname='workQueue.sqlite', worker_id=None, lease_time=600.0, max_attempts=3):
+        self.fname = fname
+        if worker_id is None:
+            worker_id = socket.gethostname() + ':' + str(os.getpid())
+        self.worker_id = worker_id
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.heartbeatStop = threading.Event()
+        self.heartbeatThread = None
+        self.db = sqlite3.connect(fname, timeout=60, isolation_level=None, check_same_thread=False)
+        # WAL needs shared memory, which network file systems do not provide
+        self.db.execute('PRAGMA journal_mode=DELETE')
+        self.db.execute('CREATE TABLE IF NOT EXISTS accounts '
+                        '(lang TEXT NOT NULL, url TEXT NOT NULL, '
+                        'status TEXT NOT NULL DEFAULT \'pending\', worker TEXT, '
+                        'lease_until REAL NOT NULL DEFAULT 0, attempts INTEGER NOT NULL DEFAULT 0, '
+                        'PRIMARY KEY (lang, url))')
+
+    def add(self, lang, urls):
+        """
+        Add the accounts that are not in the queue yet.
+        """
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.executemany('INSERT OR IGNORE INTO accounts (lang, url) VALUES (?, ?)',
+                                    [(lang, url) for url in urls])
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+
+    def lease(self, lang):
+        """
+        Lease the next pending account, or an account whose lease has
+        expired. Return its URL, or None if there is nothing left to do.
+        """
+        with self.lock:
+            now = time.time()
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.db.execute('SELECT url FROM accounts WHERE lang = ? AND attempts < ? '
+                                      'AND (status = \'pending\' OR (status = \'leased\' AND lease_until < ?)) '
+                                      'ORDER BY rowid LIMIT 1',
+                                      (lang, self.max_attempts, now)).fetchone()
+                if row is not None:
+                    self.db.execute('UPDATE accounts SET status = \'leased\', worker = ?, lease_until = ?, '
+                                    'attempts = attempts + 1 WHERE lang = ? AND url = ?',
+                                    (self.worker_id, now + self.lease_time, lang, row[0]))
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+        if row is None:
+            return None
+        return row[0]
+
+    def renew(self):
+        """
+        Extend all leases held by this worker.
+        """
+        with self.lock:
+            self.db.execute('UPDATE accounts SET lease_until = ? WHERE worker = ? AND status = \'leased\'',
+                            (time.time() + self.lease_time, self.worker_id))
+
+    def start_heartbeat(self, interval=None):
+        """
+        Renew the leases every interval seconds (by default, a third
+        of lease_time) in a background thread.
+        """
+        if interval is None:
+            interval = self.lease_time / 3
+        self.stop_heartbeat()
+        self.heartbeatStop.clear()
+
+        def heartbeat_loop():
+            while not self.heartbeatStop.wait(interval):
+                try:
+                    self.renew()
+                except sqlite3.Error as err:
+                    print('Could not renew the leases:', err)
+
+        self.heartbeatThread = threading.Thread(target=heartbeat_loop, daemon=True)
+        self.heartbeatThread.start()
+
+    def stop_heartbeat(self):
+        if self.heartbeatThread is not None:
+            self.heartbeatStop.set()
+            self.heartbeatThread.join()
+            self.heartbeatThread = None
+
+    def finish(self, lang, url, success=True):
+        """
+        Mark a leased account as done, or give it back to the queue
+        if success is False. Return False if the lease has expired
+        and the account has been taken by another worker.
+        """
+        status = 'done' if success else 'pending'
+        with self.lock:
+            nRows = self.db.execute('UPDATE accounts SET status = ?, lease_until = 0 '
+                                    'WHERE lang = ? AND url = ? AND worker = ? AND status = \'leased\'',
+                                    (status, lang, url, self.worker_id)).rowcount
+        if nRows <= 0:
+            print('The lease for', url, 'has expired before the account was finished.')
+            return False
+        return True
+
+    def counts(self, lang):
+        """
+        Return the number of accounts in each state: pending, leased, done,
+        and failed (pending accounts with no attempts left).
+        """
+        counts = {'pending': 0, 'leased': 0, 'done': 0, 'failed': 0}
+        with self.lock:
+            for status, failed, n in self.db.execute('SELECT status, attempts >= ?, COUNT(*) FROM accounts '
+                                                     'WHERE lang = ? GROUP BY status, attempts >= ?',
+                                                     (self.max_attempts, lang, self.max_attempts)):
+                if status == 'pending' and failed:
+                    status = 'failed'
+                counts[status] += n
+        return counts
+
+    def close(self):
+        self.stop_heartbeat()
+        with self.lock:
+            self.db.close()
+
+
+class JsonAccountWriter:
+    """
+    Collect all posts of an account and write them to a single
+    pretty-printed JSON file when the account has been harvested.
+    """
+    extension = '.json'
+
+    def __init__(self, filename, append=False):
+        self.filename = filename
+        self.posts = {}
+        if append:
+            # Posts downloaded earlier are kept unless they are downloaded again.
+            with open(filename, 'r', encoding='utf-8') as fIn:
+                self.posts = {int(postId): post for postId, post in json.load(fIn)['posts'].items()}
+
+    @staticmethod
+    def is_complete(filename):
+        """
+        Check if the file contains a fully harvested account.
+        """
+        return os.path.exists(filename)
+
+    @staticmethod
+    def recover(filename):
+        """
+        The file is only written when the account is complete, so there
+        is never anything to recover.
+        """
+        return False
+
+    def write_post(self, post_id, post):
+        self.posts[post_id] = post
+
+    def close(self, meta, complete=True):
+        """
+        Write the file. If the account has not been harvested completely,
+        nothing is written, so that it is downloaded again next time
+        (and the file downloaded earlier, if any, stays as it was).
+        """
+        if not complete:
+            return
+        with open(self.filename, 'w', encoding='utf-8') as fOut:
+            json.dump({'meta': meta, 'posts': self.posts}, fOut,
+                      ensure_ascii=False, indent=2, sort_keys=True)
+
+
+class JsonlAccountWriter:
+    """
+    Append each post, with its comments, to a JSON lines file as soon
+    as it has been harvested, so that the posts are never kept in memory
+    and survive a crash. Each line contains one post with the additional
+    keys type ("post") and id. The last line contains the account metadata
+    (type "meta", meta). When the file is updated by an incremental
+    harvest, new and changed posts are appended to it, so if a post
+    occurs several times, the last occurrence is the most recent version.
+    A new download is written to filename.part, which replaces the file
+    downloaded earlier only when the account is complete. If an update
+    fails, the file is cut back to the last metadata record.
+    """
+    extension = '.jsonl'
+
+    def __init__(self, filename, append=False):
+        self.filename = filename
+        self.append = append
+        if append:
+            self.outFilename = filename
+            # Size of the complete file before the update
+            self.startSize = os.path.getsize(filename)
+            self.fOut = open(filename, 'a', encoding='utf-8')
+        else:
+            self.outFilename = filename + '.part'
+            self.startSize = 0
+            self.fOut = open(self.outFilename, 'w', encoding='utf-8')
+
+    @staticmethod
+    def is_complete(filename):
+        """
+        Check if the file contains a fully harvested account, i.e. if
+        its last line is the metadata record.
+        """
+        if not os.path.exists(filename):
+            return False
+        with open(filename, 'rb') as fIn:
+            fIn.seek(0, os.SEEK_END)
+            fIn.seek(max(0, fIn.tell() - 65536))
+            lines = fIn.read().rstrip(b'\n').split(b'\n')
+        try:
+            return json.loads(lines[-1].decode('utf-8'))['type'] == 'meta'
+        except (ValueError, KeyError, TypeError):
+            return False
+
+    @staticmethod
+    def complete_size(filename):
+        """
+        Return the size of the file up to the end of its last metadata
+        record, or 0 if there is none.
+        """
+        size = 0
+        offset = 0
+        with open(filename, 'rb') as fIn:
+            for line in fIn:
+                offset += len(line)
+                # Records are written with sorted keys, so "meta" comes first
+                if not line.startswith(b'{"meta": ') or not line.endswith(b'\n'):
+                    continue
+                try:
+                    if json.loads(line.decode('utf-8'))['type'] == 'meta':
+                        size = offset
+                except (ValueError, KeyError, TypeError):
+                    continue
+        return size
+
+    @staticmethod
+    def recover(filename):
+        """
+        If an update of the file was interrupted, e.g. by a crash, remove
+        everything after the last metadata record, so that the file
+        describes the account as it was after the last complete harvest.
+        Return True if the file has been cut.
+        """
+        if not os.path.exists(filename) or JsonlAccountWriter.is_complete(filename):
+            return False
+        size = JsonlAccountWriter.complete_size(filename)
+        if size <= 0:
+            return False
+        with open(filename, 'r+b') as fFile:
+            fFile.truncate(size)
+        return True
+
+    def write_post(self, post_id, post):
+        record = dict(post)
+        record['type'] = 'post'
+        record['id'] = post_id
+        self.fOut.write(json.dumps(record, ensure_ascii=False, sort_keys=True) + '\n')
+        self.fOut.flush()
+
+    def close(self, meta, complete=True):
+        """
+        Write the metadata record and close the file. If the account has
+        not been harvested completely, the file downloaded earlier, if any,
+        stays as it was: a new download is left in filename.part, and
+        the posts appended by an update are removed.
+        """
+        if complete:
+            self.fOut.write(json.dumps({'type': 'meta', 'meta': meta}, ensure_ascii=False, sort_keys=True) + '\n')
+        self.fOut.close()
+        if complete and not self.append:
+            os.replace(self.outFilename, self.filename)
+        elif not complete and self.append:
+            with open(self.filename, 'r+b') as fFile:
+                fFile.truncate(self.startSize)
+
+
+class VkHarvester:
+    """
+    Class with methods for harvesting linguictic data and metadata
+    from vk.com using their API.
+    """
+    rxVkId = re.compile('\\[((?:id|club)[0-9]+)\\|([^\r\n\\[\\]]+)\\]')
+    writers = {'json': JsonAccountWriter, 'jsonl': JsonlAccountWriter}
+    # vk errors that are worth retrying: "Unknown error occurred"
+    # and "Internal server error"
+    retry_error_codes = (1, 10)
+
+    def __init__(self, lang, output_format='json', metadata_store=None, repost_store=None):
+        self.lang = lang
+        # Languages of the accounts that belong to several languages,
+        # {owner ID: list of languages}, see MultiLanguageHarvester
+        self.account_languages = {}
+        # With output_format='jsonl', each post is written to disk as soon
+        # as it has been downloaded, instead of dumping the whole account
+        # to a JSON file in the end.
+        self.writer_class = self.writers[output_format]
+        # In order to use the vk API, you have to register your own
+        # app and get an acces token. The token should be stored in
+        # config.txt as plain text. The token may be followed by
+        # the number of requests per second allowed for it, separated
+        # by a whitespace (3 by default). If there are several tokens,
+        # one per line, the accounts are harvested concurrently, each
+        # token having its own rate budget.
+        self.access_token = ''
+        self.access_tokens = []
+        self.token_limits = {}
+        self.rate_limiters = {}
+        self.http_sessions = {}
+        self.api_url = 'https://api.vk.com/method/'
+        # Failed requests are repeated up to self.max_retries times, with
+        # exponentially growing pauses (starting at self.retry_delay seconds).
+        self.max_retries = 5
+        self.retry_delay = 1.0
+        self.max_retry_delay = 120.0
+        # Settings that differ between the worker threads, such as
+        # the token currently in use, are stored in self.local.
+        self.local = threading.local()
+        # User metadata and mentions are stored in userData.json and
+        # userMentions.json by default. Pass an SqliteMetadataStore
+        # instance to keep them in an SQLite database instead.
+        if metadata_store is None:
+            metadata_store = JsonMetadataStore()
+        self.metadataStore = metadata_store
+        self.userMetadata = self.metadataStore.userMetadata
+        self.userMentions = self.metadataStore.userMentions
+        # Lock for the user metadata and mention caches shared by all threads
+        self.cacheLock = self.metadataStore.lock
+        # If a RepostStore is passed, the texts of reposted messages are
+        # stored (and searched for mentions) only once, and the posts
+        # contain references to them.
+        self.repostStore = repost_store
+        # IDs of the users that vk did not return any data for
+        self.missingAuthors = set()
+        # If False, only the fields needed for the output are downloaded
+        # and kept for the authors of posts and comments.
+        self.full_author_profiles = False
+        self.tokenLock = threading.Lock()
+        try:
+            self.read_config('config.txt')
+        except OSError:
+            print('Could not load the access token.')
+        self.urls = self.get_urls()
+        self.request_count = 0
+        # Metrics of the harvest, see HarvestStats
+        self.stats = HarvestStats()
+        # Maximum number of API calls per execute request (vk allows 25).
+        # The actual number is chosen by a BatchSizeController for each account.
+        self.n_batch_calls = 25
+        # In an incremental harvest, this is how many of the posts downloaded
+        # earlier are checked for new comments before paging stops.
+        self.recheck_depth = 100
+        # If True, the comments, authors and output of each account are
+        # processed in a pipeline of threads while the posts are being
+        # paged through (see make_pipeline). Each queue between the stages
+        # holds up to self.pipeline_queue_size pages.
+        self.pipeline = False
+        self.pipeline_queue_size = 4
+        self.pipelines = []
+        self.pipelineLock = threading.Lock()
+        # Number of posts and the newest post of each wall at the time
+        # it was last harvested, see plan_harvest
+        self.manifest = {}
+        self.manifestLock = threading.Lock()
+        # Fields of the posts and comments that the execute scripts return.
+        # Everything else (attachments, likes etc.) is dropped on the vk side.
+        # Set to None to get the complete objects. copy_history and is_pinned
+        # are missing in most posts; the projection (see project_code) only
+        # works if items@.field returns null for them. This has not been
+        # checked against the live API, so if the columns of a response
+        # do not match, the account is downloaded without projection.
+        self.post_fields = ['id', 'date', 'text', 'from_id', 'copy_history', 'comments', 'is_pinned']
+        self.comment_fields = ['id', 'date', 'text', 'from_id']
+
+    def read_config(self, fname):
+        """
+        Read the access tokens and their rate limits from the config file.
+        """
+        with open(fname, 'r', encoding='utf-8') as fConfig:
+            for line in fConfig:
+                values = line.strip().split()
+                if len(values) <= 0 or values[0] in self.access_tokens:
+                    continue
+                self.access_tokens.append(values[0])
+                if len(values) > 1:
+                    try:
+                        rate = float(values[1])
+                    except ValueError:
+                        rate = 0
+                    if rate > 0:
+                        self.token_limits[values[0]] = rate
+                    else:
+                        print('Wrong request rate for a token:', values[1], '(using the default one)')
+        if len(self.access_tokens) > 0:
+            self.access_token = self.access_tokens[0]
+
+    def current_token(self):
+        """
+        Return the access token used by the current thread.
+        """
+        return getattr(self.local, 'access_token', self.access_token)
+
+    def get_rate_limiter(self, access_token):
+        """
+        Return the rate limiter for the given access token,
+        creating it if needed.
+        """
+        with self.tokenLock:
+            if access_token not in self.rate_limiters:
+                self.rate_limiters[access_token] = RateLimiter(rate=self.token_limits.get(access_token, 3))
+            return self.rate_limiters[access_token]
+
+    def get_http_session(self, access_token):
+        """
+        Return the keep-alive HTTP session for the given access token,
+        creating it if needed. Pipeline stage threads use their own
+        sessions, since they share a token with the thread of the account.
+        """
+        session = getattr(self.local, 'http_session', None)
+        if session is not None:
+            return session
+        with self.tokenLock:
+            if access_token not in self.http_sessions:
+                self.http_sessions[access_token] = HttpSession()
+            return self.http_sessions[access_token]
+
     def get_urls(self):
         """
         Read all URLs of vk pages from a plain-text list.
@@ -86,26 +1478,76 @@ class VkHarvester:
         if not os.path.exists(self.lang + '/users'):
             os.makedirs(self.lang + '/users')
 
-    def save_user_ids(self, fname_mentions='userMentions.json', fname_userdata='userData.json'):
+    def account_filename(self, screen_name, is_group=True):
+        """
+        Return the path to the output file for a group or a user.
+        """
+        if is_group:
+            return self.lang + '/' + screen_name + self.writer_class.extension
+        return self.lang + '/users/' + screen_name + self.writer_class.extension
+
+    def state_filename(self, filename):
+        """
+        Return the path to the file that stores the harvest state
+        of the account whose posts are stored in filename.
+        """
+        return os.path.splitext(filename)[0] + '.state.json'
+
+    def load_state(self, filename):
+        """
+        Load the harvest state of an account: the ID and the date
+        of its newest post and the number of comments for each post.
+        Return an empty dictionary if the account has not been harvested
+        with this version of the harvester yet.
+        """
+        try:
+            with open(self.state_filename(filename), 'r', encoding='utf-8') as fState:
+                return json.load(fState)
+        except FileNotFoundError:
+            return {}
+
+    def save_state(self, filename, state):
+        """
+        Write the harvest state of an account.
+        """
+        with open(self.state_filename(filename), 'w', encoding='utf-8') as fState:
+            json.dump(state, fState, ensure_ascii=False, sort_keys=True)
+
+    def manifest_filename(self):
+        """
+        Return the path to the file that describes the walls as they
+        were when they were last harvested.
+        """
+        return os.path.join(self.lang, 'manifest.json')
+
+    def load_manifest(self):
+        """
+        Load the manifest: a dictionary {owner ID: wall summary}
+        (see get_wall_summaries).
+        """
+        try:
+            with open(self.manifest_filename(), 'r', encoding='utf-8') as fManifest:
+                self.manifest = json.load(fManifest)
+        except FileNotFoundError:
+            self.manifest = {}
+
+    def update_manifest(self, owner_id, summary):
+        """
+        Record the summary of a wall that has been harvested and write the manifest.
+        """
+        with self.manifestLock:
+            self.manifest[str(owner_id)] = summary
+            with open(self.manifest_filename(), 'w', encoding='utf-8') as fManifest:
+                json.dump(self.manifest, fManifest, ensure_ascii=False, indent=1, sort_keys=True)
+
+    def save_user_ids(self, fname_mentions=None, fname_userdata=None):
         """
         Write information about vk user IDs mentioned in the groups.
+        If the file names are given, also export it to these JSON files.
         """
-        for k in self.userMentions:
-            self.userMentions[k] = [username for username in sorted(self.userMentions[k])]
-        jsonVkMentions = json.dumps(self.userMentions,
-                                    ensure_ascii=False,
-                                    indent=2,
-                                    sort_keys=True)
-        jsonVkData = json.dumps(self.userMetadata,
-                                ensure_ascii=False,
-                                indent=2,
-                                sort_keys=True)
-        with open(fname_mentions, 'w', encoding='utf-8') as fVkDesc:
-            fVkDesc.write(jsonVkMentions)
-        with open(fname_userdata, 'w', encoding='utf-8') as fVkData:
-            fVkData.write(jsonVkData)
-        for k in self.userMentions:
-            self.userMentions[k] = set(self.userMentions[k])
+        self.metadataStore.save()
+        if fname_mentions is not None and fname_userdata is not None:
+            self.metadataStore.export_json(fname_mentions, fname_userdata)
 
     def enhance_user_data(self):
         """
@@ -115,7 +1557,9 @@ class VkHarvester:
         """
         userIDs = list(self.userMetadata.keys())
         completeUserData = self.get_users(userIDs)
-        self.userMetadata = {user['id']: user for user in completeUserData}
+        with self.cacheLock:
+            for user in completeUserData:
+                self.userMetadata[str(user['id'])] = AuthorRecord.from_dict(user)
         print('User data successfully enhanced.')
 
     def extract_info(self, text):
@@ -124,62 +1568,143 @@ class VkHarvester:
         mentioned in the text of a post or a comment.
         """
         mentions = self.rxVkId.findall(text)
-        for m in mentions:
-            if m[0] not in self.userMentions:
-                self.userMentions[m[0]] = set()
-            self.userMentions[m[0]].add(m[1].strip().lower())
+        if len(mentions) <= 0:
+            return
+        self.metadataStore.add_mentions([(m[0], m[1].strip().lower()) for m in mentions])
+
+    def retry_pause(self, n_attempt):
+        """
+        Return the pause before the next attempt to send a failed query:
+        exponential backoff with random jitter.
+        """
+        delay = min(self.retry_delay * 2 ** n_attempt, self.max_retry_delay)
+        return delay * (0.5 + random.random() / 2)
 
     def get_response(self, url, params):
         """
-        Send an HTTP query, sleep a little after every 1000 queries.
+        Send an HTTP query, respecting the rate limits of the access token.
+        If the API rejects the query because of the rate limits, back off
+        and try again. Network errors, server errors (HTTP 5xx) and
+        internal vk errors are retried with exponential backoff.
+        Return the decoded response, or None if the query failed.
         """
-        paramsEncoded = parse.urlencode(params)
-        if self.request_count == 1000:
-            self.request_count = 0
-            time.sleep(100)
-        # Free vk API has a limit of 3 requests per second.
-        time.sleep(0.35)
-        urlFull = url + '?' + paramsEncoded
-        try:
-            if 'v' not in params:
-                urlFull += '&v=5.95'
-            if 'access_token' not in params:
-                urlFull += '&access_token=' + self.access_token
-            # print(urlFull)
-            entity = requests.urlopen(urlFull).read()
-            entity = json.loads(str(entity.decode()))
+        params = dict(params)
+        if 'v' not in params:
+            params['v'] = '5.95'
+        if 'access_token' not in params:
+            params['access_token'] = self.current_token()
+        rateLimiter = self.get_rate_limiter(params['access_token'])
+        session = self.get_http_session(params['access_token'])
+        method = url.rstrip('/').rsplit('/', 1)[-1]
+        entity = None
+        for iAttempt in range(self.max_retries + 1):
+            with self.stats.timer('rate_limit_sleep'):
+                rateLimiter.wait()
+            self.request_count += 1
+            timeStart = time.monotonic()
+            nWireBytes = 0
+            try:
+                body, nWireBytes = session.request(url, params)
+                self.local.response_time = time.monotonic() - timeStart
+                # The batch size controller watches the size of the decoded
+                # response, which is what the API limits; the statistics
+                # count the bytes actually received.
+                self.local.response_bytes = len(body)
+                with self.stats.timer('json_decode'):
+                    entity = json.loads(body.decode('utf-8'))
+            except HttpError as err:
+                print('Error when retrieving a URL:', url, err)
+                self.stats.record_request(method, time.monotonic() - timeStart, error='http' + str(err.status))
+                if err.status < 500:
+                    return None
+                entity = None
+                rateLimiter.pause(self.retry_pause(iAttempt))
+                continue
+            except (OSError, http.client.HTTPException, ValueError) as err:
+                # Network errors and truncated or corrupted responses
+                print('Error when retrieving a URL:', url, repr(err))
+                self.stats.record_request(method, time.monotonic() - timeStart, nWireBytes,
+                                          error=type(err).__name__)
+                entity = None
+                rateLimiter.pause(self.retry_pause(iAttempt))
+                continue
+            errorCode = None
+            if type(entity) == dict and 'error' in entity and 'error_code' in entity['error']:
+                errorCode = entity['error']['error_code']
+            self.stats.record_request(method, self.local.response_time, nWireBytes, error=errorCode)
+            if errorCode is not None:
+                if rateLimiter.backoff(errorCode):
+                    continue
+                if errorCode in self.retry_error_codes:
+                    print('vk error', errorCode, 'when retrieving a URL:', url)
+                    rateLimiter.pause(self.retry_pause(iAttempt))
+                    continue
+            rateLimiter.success()
             return entity
-        except:
-            print('Error when retrieving a URL:', urlFull)
-            # return get_response(url, params)
-            return None
+        print('Giving up on a URL after', self.max_retries + 1, 'attempts:', url)
+        return entity
+
+    def report_batch(self, batch_size, response):
+        """
+        Tell the batch size controller how the last execute request went.
+        response is its decoded result, or None if it failed.
+        Return False if it makes no sense to try again.
+        """
+        if response is None:
+            print('Execute request failed, reducing the number of calls per request.')
+            return batch_size.failure()
+        batch_size.success(getattr(self.local, 'response_bytes', 0),
+                           getattr(self.local, 'response_time', 0.0))
+        return True
 
-    def get_account_extended(self, method, fields, id_field, ids):
+    def get_account_extended(self, method, fields, id_field, ids, failed_ids=None):
         """
         Retrieve user or group data by user/group IDs. The URL specifies
         the API function to be used (groups and users are served by different
-        functions).
+        functions). If failed_ids is a list, the IDs from the requests
+        that failed are added to it.
         """
         result = []
-        for iRange in range(len(ids) // 200 + 1):
-            parameters = {id_field: ','.join(str(i) for i in ids[iRange * 200:(iRange + 1) * 200]),
+        for iStart in range(0, len(ids), 200):
+            chunk = ids[iStart:iStart + 200]
+            parameters = {id_field: ','.join(str(i) for i in chunk),
                           'fields': fields}
-            accountData = self.get_response('https://api.vk.com/method/' + method, parameters)
-            if 'response' in accountData:
+            accountData = self.get_response(self.api_url + method, parameters)
+            if accountData is not None and 'response' in accountData:
                 result += accountData['response']
             else:
                 print(method, ': Error when retrieveing account data:', parameters, accountData)
+                if failed_ids is not None:
+                    failed_ids += chunk
         return result
 
-    def get_users(self, ids):
+    def get_users(self, ids, fields=None, failed_ids=None):
+        """
+        Retrieve vk user data by user IDs. By default, all fields
+        relevant for sociolinguistic metadata are requested.
+        failed_ids: see get_account_extended
+        """
+        if fields is None:
+            fields = 'sex, bdate, city, country, home_town, '\
+                     'career, domain, education, '\
+                     'followers_count, occupation, '\
+                     'schools, screen_name, universities'
+        return self.get_account_extended('users.get', fields, 'user_ids', ids, failed_ids=failed_ids)
+
+    def get_authors(self, ids, failed_ids=None):
         """
-        Retrieve vk user data by user IDs.
+        Retrieve data for the authors of posts and comments by user IDs
+        and return them as AuthorRecord objects. Unless
+        self.full_author_profiles is True, only the essential fields
+        are requested.
+        failed_ids: see get_account_extended
         """
-        fields = 'sex, bdate, city, country, home_town, '\
-                 'career, domain, education, '\
-                 'followers_count, occupation, '\
-                 'schools, screen_name, universities'
-        return self.get_account_extended('users.get', fields, 'user_ids', ids)
+        if self.full_author_profiles:
+            return [AuthorRecord.from_dict(user) for user in self.get_users(ids, failed_ids=failed_ids)
+                    if 'id' in user]
+        return [AuthorRecord.from_dict(user, keep_extra=False)
+                for user in self.get_users(ids, fields=AuthorRecord.short_fields, failed_ids=failed_ids)
+                if 'id' in user]
 
     def get_groups_extended(self, ids):
         """
@@ -202,6 +1727,8 @@ class VkHarvester:
         Return a shortened dictionary describing a user, only with
         the keys that need to be saved in json files.
         """
+        if isinstance(user, AuthorRecord):
+            return user.essential()
         newUserDict = {'id': user['id'], 'first_name': user['first_name'],
                        'last_name': user['last_name'], 'sex': user['sex']}
         if 'city' in user:
@@ -212,6 +1739,48 @@ class VkHarvester:
             newUserDict['home_town'] = user['home_town']
         return newUserDict
 
+    def prefetch_authors(self, messages, account_dict):
+        """
+        Collect the IDs of all users who wrote the posts or comments
+        in the list and are not in the cache yet, and download their data
+        in bulk (up to 200 users per call), so that get_author does not
+        have to make a separate call for each of them.
+        """
+        authorIDs = set()
+        cachedIDs = set()
+        with self.cacheLock:
+            for message in messages:
+                if 'from_id' not in message:
+                    continue
+                authorID = message['from_id']
+                if authorID <= 0 or authorID == account_dict['meta']['id']:
+                    continue
+                if str(authorID) in self.userMetadata or authorID in self.missingAuthors:
+                    cachedIDs.add(authorID)
+                else:
+                    authorIDs.add(authorID)
+        # Each distinct author of the messages is one cache lookup: a hit if
+        # they were known before, a miss if they have to be downloaded.
+        self.stats.count('author_cache_hits', len(cachedIDs))
+        if len(authorIDs) <= 0:
+            return
+        authorIDs = sorted(authorIDs)
+        self.stats.count('author_cache_misses', len(authorIDs))
+        self.stats.count('authors_prefetched', len(authorIDs))
+        failedIDs = []
+        with self.stats.timer('author_lookups'):
+            authors = self.get_authors(authorIDs, failed_ids=failedIDs)
+        failedIDs = set(failedIDs)
+        with self.cacheLock:
+            for author in authors:
+                self.userMetadata[str(author.id)] = author
+            # Only the users that vk has not returned in a successful
+            # response are missing; the others will be asked for again
+            # by get_author.
+            for authorID in authorIDs:
+                if str(authorID) not in self.userMetadata and authorID not in failedIDs:
+                    self.missingAuthors.add(authorID)
+
     def get_author(self, message_json, account_dict):
         """
         Check if the post author is a user or a group (groups have negative IDs).
@@ -224,36 +1793,95 @@ class VkHarvester:
         if authorID == account_dict['meta']['id'] * -1 or authorID == account_dict['meta']['id']:
             return account_dict['meta']['screen_name']
         elif authorID > 0:
-            if str(authorID) in self.userMetadata:
-                return self.leave_essential_data(self.userMetadata[str(authorID)])
-            author = self.get_user(authorID)
+            # The authors found in the cache here have been counted
+            # as lookups by prefetch_authors already.
+            author = self.userMetadata.get(str(authorID))
             if author is not None:
-                self.userMetadata[str(authorID)] = author
-            else:
-                author = {}
-            return self.leave_essential_data(author)
+                return self.leave_essential_data(author)
+            if authorID in self.missingAuthors:
+                return {}
+            self.stats.count('author_cache_misses')
+            failedIDs = []
+            authors = self.get_authors([authorID], failed_ids=failedIDs)
+            if len(authors) <= 0:
+                if len(failedIDs) <= 0:
+                    with self.cacheLock:
+                        self.missingAuthors.add(authorID)
+                return {}
+            with self.cacheLock:
+                self.userMetadata[str(authorID)] = authors[0]
+            return authors[0].essential()
         return {}
 
-    def execute_code(self, offset, command, n_msg):
+    def execute_code(self, offset, command, n_msg, fields=None, n_calls=None):
         """
         Generate a VKScript code snippet to send via the execute API function.
-        The script makes up to self.n_batch_calls calls to get the posts consecutively.
+        The script makes up to n_calls (by default, self.n_batch_calls) calls
+        to get the posts consecutively.
         offset: offset of the post to start with
         command: a string with a single API call
         n_msg: number of messages to download
+        fields: if not None, only return these fields of each message
+        (see project_code)
         """
         # No more than 25 API calls are allowed within one Execute script.
-        return ('var objs = [];' +
+        if n_calls is None:
+            n_calls = self.n_batch_calls
+        if fields is None:
+            return ('var objs = [];' +
+                    'var offset = 0;' +
+                    # read while the call limit is exceeded or all messgaes have been harvested
+                    'while (offset < ' + str(n_calls * 100) +
+                    ' && (offset + ' + str(offset * 100) + ') < ' + str(n_msg) + ')' +
+                    '{' +
+                    'objs = objs + ' + command + ', "count": "100", "offset": offset + ' +
+                    str(offset * 100) + '}).items;' +
+                    'offset = offset + 100;' +
+                    '};' +
+                    'return objs;')
+        return ('var items;' +
+                ''.join('var f' + str(i) + ' = [];' for i in range(len(fields))) +
                 'var offset = 0;' +
-                # read while the call limit is exceeded or all messgaes have been harvested
-                'while (offset < ' + str(self.n_batch_calls * 100) +
+                'while (offset < ' + str(n_calls * 100) +
                 ' && (offset + ' + str(offset * 100) + ') < ' + str(n_msg) + ')' +
                 '{' +
-                'objs = objs + ' + command + ', "count": "100", "offset": offset + ' +
+                'items = ' + command + ', "count": "100", "offset": offset + ' +
                 str(offset * 100) + '}).items;' +
+                ''.join('f' + str(i) + ' = f' + str(i) + ' + items@.' + fields[i] + ';'
+                        for i in range(len(fields))) +
                 'offset = offset + 100;' +
                 '};' +
-                'return objs;')
+                'return {' + ', '.join('"' + fields[i] + '": f' + str(i)
+                                      for i in range(len(fields))) + '};')
+
+    @staticmethod
+    def project_code(items, fields):
+        """
+        Return a VKScript expression that turns the list of objects
+        stored in the variable items into a dictionary with one list
+        of values for each of the fields. This way, vk only sends the
+        fields we need. The lists can only be matched if vk returns
+        null for the objects that lack a field, see unpack_items.
+        """
+        return '{' + ', '.join('"' + field + '": ' + items + '@.' + field for field in fields) + '}'
+
+    @staticmethod
+    def unpack_items(columns, fields):
+        """
+        Turn the dictionary of lists returned by a script with field
+        projection back into a list of objects. Missing values are
+        left out. Return None if the lists have different lengths.
+        """
+        if fields is None or type(columns) == list:
+            return columns
+        if type(columns) != dict or any(type(columns.get(field)) != list for field in fields):
+            return None
+        nItems = len(columns[fields[0]])
+        if any(len(columns[field]) != nItems for field in fields):
+            print('Projected fields have different lengths.')
+            return None
+        return [{field: columns[field][i] for field in fields if columns[field][i] is not None}
+                for i in range(nItems)]
 
     def write_comment(self, comment, account_dict, ps_id):
         """
@@ -265,45 +1893,211 @@ class VkHarvester:
         if len(comm_author) <= 0 or 'text' not in comment:
             return
         self.extract_info(comment['text'])
+        self.stats.count('comments')
         account_dict['posts'][ps_id]['comments'][comment['id']] = {'date': comm_date,
                                                                    'text': comment['text'],
                                                                    'author': comm_author,
                                                                    'sort': comment['date']}
 
-    def get_comments(self, ps, account_dict, is_group=True):
+    def get_comments(self, ps, account_dict, is_group=True, batch_size=None, failed_posts=None):
         """
         Retrieve all comments to a given post ps in the group gr.
+        The number of comments is taken from the post itself.
+        batch_size is the BatchSizeController of the account.
+        failed_posts: see fetch_comments
+        """
+        accountId = account_dict['meta']['id']
+        if is_group:
+            accountId *= -1     # Groups have negative IDs
+        comments = self.fetch_comments(ps, accountId, batch_size=batch_size, failed_posts=failed_posts)
+        self.prefetch_authors(comments, account_dict)
+        for j in range(len(comments)):
+            self.write_comment(comments[j], account_dict, ps['id'])
+
+    def fetch_comments(self, ps, account_id, batch_size=None, failed_posts=None):
+        """
+        Download all comments to the post ps on the wall of account_id
+        and return them as a list, without processing them. If failed_posts
+        is a list and not all comments could be downloaded, the post
+        is added to it.
         """
         offset = 0              # comment number offset, in hundreds
+        if batch_size is None:
+            batch_size = BatchSizeController(max_size=self.n_batch_calls)
+        accountId = account_id
+        allComments = []
+        commentFields = self.comment_fields
+        comm_num = self.comment_count(ps)
+        print('post', ps['id'], ':', comm_num, 'comments will be loaded.')
+        off_n = comm_num // 100 + 1
+        while offset < off_n:
+            # print('Getting a comment...')
+            command = 'API.wall.getComments({"owner_id": ' +\
+                      str(accountId) +\
+                      ', "post_id": ' + str(ps['id'])
+            nCalls = batch_size.size
+            code = self.execute_code(offset, command, comm_num, fields=commentFields, n_calls=nCalls)
+            comm = self.get_response(self.api_url + 'execute', {'code': code})
+            # print('comment:', comm)
+            comments = None
+            if comm is not None and 'response' in comm:
+                comments = self.unpack_items(comm['response'], commentFields)
+                if comments is None and commentFields is not None:
+                    print('Could not unpack the projected comments, downloading complete comments instead.')
+                    commentFields = None
+                    continue
+            if not self.report_batch(batch_size, comments):
+                print('Could not download comments to post', ps['id'])
+                if failed_posts is not None:
+                    failed_posts.append(ps)
+                break
+            if comments is None:
+                # Try again at the same offset with fewer calls
+                continue
+            allComments += comments
+            offset += nCalls
+        return allComments
+
+    def comments_batch_code(self, account_id, post_ids):
+        """
+        Generate a VKScript code snippet that downloads up to 100 comments
+        for each of the posts in the list, one API call per post. The script
+        returns a list with a list of comments (or false) for each post.
+        If self.comment_fields is not None, each list of comments is
+        projected to these fields (see project_code).
+        """
+        calls = ['API.wall.getComments({"owner_id": ' + str(account_id) +
+                 ', "post_id": ' + str(postId) + ', "count": "100"}).items'
+                 for postId in post_ids]
+        if self.comment_fields is None:
+            return 'return [' + ','.join(calls) + '];'
+        return ('var items;' +
+                'var result = [];' +
+                ''.join('items = ' + call + ';' +
+                        'result.push(' + self.project_code('items', self.comment_fields) + ');'
+                        for call in calls) +
+                'return result;')
+
+    def wall_summary_code(self, owner_ids):
+        """
+        Generate a VKScript code snippet that gets the number of posts
+        and the IDs and dates of the two first posts (the first one
+        may be pinned) for each of the walls in the list, one API call
+        per wall. The script returns a list with a dictionary for each wall.
+        """
+        return ('var wall;' +
+                'var result = [];' +
+                ''.join('wall = API.wall.get({"owner_id": ' + str(ownerId) + ', "count": "2"});' +
+                        'result.push({"count": wall.count, "id": wall.items@.id, "date": wall.items@.date});'
+                        for ownerId in owner_ids) +
+                'return result;')
+
+    def get_wall_summaries(self, owner_ids):
+        """
+        Get the number of posts and the ID and date of the newest post
+        for each of the walls, checking up to self.n_batch_calls walls
+        with one execute request. Return a dictionary {owner ID: summary}.
+        The walls that could not be checked are left out.
+        """
+        summaries = {}
+        for i in range(0, len(owner_ids), self.n_batch_calls):
+            batch = owner_ids[i:i + self.n_batch_calls]
+            response = self.get_response(self.api_url + 'execute', {'code': self.wall_summary_code(batch)})
+            if response is None or 'response' not in response:
+                print('Could not check the walls', batch, ':', response)
+                continue
+            for ownerId, wall in zip(batch, response['response']):
+                if type(wall) != dict or type(wall.get('count')) != int:
+                    continue
+                summaries[ownerId] = {'count': wall['count'],
+                                      'newest_id': max(wall.get('id') or [0]),
+                                      'newest_date': max(wall.get('date') or [0])}
+        return summaries
+
+    def get_comments_batch(self, posts, account_dict, is_group=True, batch_size=None, failed_posts=None):
+        """
+        Retrieve all comments to the posts in the list. Comments to the posts
+        with no more than 100 comments are downloaded for many posts at once,
+        with one execute request per batch_size.size posts. Longer
+        threads are downloaded post by post.
+        batch_size is the BatchSizeController of the account.
+        failed_posts: see fetch_comments
+        """
         accountId = account_dict['meta']['id']
         if is_group:
             accountId *= -1     # Groups have negative IDs
-        par_comm = {'owner_id': accountId, 'post_id': ps['id'], 'count': '0'}
-        comm = self.get_response('https://api.vk.com/method/wall.getComments', par_comm)
-        # print(comm)
-        if 'response' in comm:
-            comm_num = comm['response']['count']
-            print('post', ps['id'], ':', comm_num, 'comments will be loaded.')
-            off_n = comm_num // 100 + 1
-            while offset < off_n:
-                # print('Getting a comment...')
-                command = 'API.wall.getComments({"owner_id": ' +\
-                          str(accountId) +\
-                          ', "post_id": ' + str(ps['id'])
-                code = self.execute_code(offset, command, comm_num)
-                comm = self.get_response('https://api.vk.com/method/execute',
-                                         {'code': code, 'access_token': self.access_token})
-                # print('comment:', comm)
-                if 'response' in comm:
-                    for j in range(len(comm['response'])):
-                        self.write_comment(comm['response'][j], account_dict, ps['id'])
-                offset += self.n_batch_calls
-                time.sleep(0.5)
-
-    def write_post(self, wall, n_post, account_dict, write_reposts=True, is_group=True):
+        postComments = self.fetch_comments_batch(posts, accountId, batch_size=batch_size,
+                                                 failed_posts=failed_posts)
+        self.prefetch_authors([c for ps, comments in postComments for c in comments], account_dict)
+        for ps, comments in postComments:
+            for comment in comments:
+                self.write_comment(comment, account_dict, ps['id'])
+
+    def fetch_comments_batch(self, posts, account_id, batch_size=None, failed_posts=None):
+        """
+        Download all comments to the posts in the list on the wall
+        of account_id (see get_comments_batch) without processing them.
+        Return a list of (post, list of comments) tuples.
+        failed_posts: see fetch_comments
+        """
+        if batch_size is None:
+            batch_size = BatchSizeController(max_size=self.n_batch_calls)
+        accountId = account_id
+        postComments = []
+        shortPosts = [ps for ps in posts if 0 < self.comment_count(ps) <= 100]
+        for ps in posts:
+            if self.comment_count(ps) > 100:
+                postComments.append((ps, self.fetch_comments(ps, accountId, batch_size=batch_size,
+                                                             failed_posts=failed_posts)))
+        iPost = 0
+        while iPost < len(shortPosts):
+            batch = shortPosts[iPost:iPost + batch_size.size]
+            print(len(batch), 'posts:', sum(self.comment_count(ps) for ps in batch),
+                  'comments will be loaded.')
+            code = self.comments_batch_code(accountId, [ps['id'] for ps in batch])
+            comm = self.get_response(self.api_url + 'execute', {'code': code})
+            comments = None
+            if (comm is not None and 'response' in comm and type(comm['response']) == list
+                    and len(comm['response']) == len(batch)):
+                comments = [self.unpack_items(postComments, self.comment_fields)
+                            for postComments in comm['response']]
+            if not self.report_batch(batch_size, comments):
+                # Skip the first post of the batch, so that the others
+                # have a chance to be downloaded in the next requests
+                print('Could not download comments to post', batch[0]['id'])
+                if failed_posts is not None:
+                    failed_posts.append(batch[0])
+                iPost += 1
+                continue
+            if comments is None:
+                # Try again with fewer posts in the batch
+                continue
+            iPost += len(batch)
+            for ps, psComments in zip(batch, comments):
+                if type(psComments) == list:
+                    postComments.append((ps, psComments))
+                    continue
+                # The call for this post failed inside the script (false instead
+                # of a list), or its projection is broken: try it on its own.
+                print('Could not download comments to post', ps['id'], 'in a batch, trying it separately.')
+                postComments.append((ps, self.fetch_comments(ps, accountId, batch_size=batch_size,
+                                                             failed_posts=failed_posts)))
+        return postComments
+
+    @staticmethod
+    def comment_count(ps):
+        """
+        Return the number of comments to a post, as reported by wall.get.
+        """
+        if 'comments' in ps and 'count' in ps['comments']:
+            return ps['comments']['count']
+        return 0
+
+    def write_post(self, wall, n_post, account_dict, write_reposts=True):
         """
         Add a post from the wall with the index n_post to the account stored in account_dict.
         If write_reposts is False, do not save the text of reposted messages.
+        The comments are added later by get_comments_batch.
         """
         ps = wall[n_post]
         # print(ps)
@@ -328,94 +2122,302 @@ class VkHarvester:
                                            'comments': {},
                                            'sort': ps['date']}
         if len(postCopyText) > 0:
-            self.extract_info(postCopyText)
-            if write_reposts:
-                account_dict['posts'][ps['id']]['copy_text'] = postCopyText
+            if self.repostStore is not None:
+                copyRef, isNew = self.repostStore.add(postSource, postCopyId, postCopyText)
+                if isNew:
+                    self.extract_info(postCopyText)
+                    self.stats.count('reposts_stored')
+                else:
+                    self.stats.count('reposts_deduplicated')
+                if write_reposts:
+                    account_dict['posts'][ps['id']]['copy_ref'] = copyRef
+            else:
+                self.extract_info(postCopyText)
+                if write_reposts:
+                    account_dict['posts'][ps['id']]['copy_text'] = postCopyText
             account_dict['posts'][ps['id']]['copy_id'] = postCopyId
             account_dict['posts'][ps['id']]['post_src_owner'] = postSource
-        if 'comments' in ps and 'count' in ps['comments'] and ps['comments']['count'] > 0:
-            self.get_comments(ps, account_dict, is_group)
+        self.stats.count('posts')
+        state = account_dict['state']
+        state['comment_counts'][str(ps['id'])] = self.comment_count(ps)
+        if ps['id'] > state['newest_id']:
+            state['newest_id'] = ps['id']
+            state['newest_date'] = ps['date']
+
+    def flush_posts(self, account_dict):
+        """
+        Hand all complete posts of the account over to the output writer.
+        """
+        with self.stats.timer('output'):
+            for postId in list(account_dict['posts']):
+                account_dict['writer'].write_post(postId, account_dict['posts'].pop(postId))
+
+    def make_pipeline(self, account_dict, is_group=True, failed_posts=None):
+        """
+        Create a pipeline that processes the pages of posts of an account
+        downloaded by get_posts. Its stages download the comments, look up
+        the authors, process the posts and comments (including extracting
+        the mentions) and hand them over to the output writer. All stages
+        use the access token of the current thread.
+        failed_posts: see fetch_comments
+        """
+        accountId = account_dict['meta']['id']
+        writeReposts = False
+        if is_group:
+            accountId *= -1     # Groups have negative IDs
+            writeReposts = True
+        accessToken = self.current_token()
+        batchSize = BatchSizeController(max_size=self.n_batch_calls)
+
+        def on_start():
+            self.local.access_token = accessToken
+            self.local.http_session = HttpSession()
+
+        def on_stop():
+            self.local.http_session.close()
+            del self.local.http_session
+
+        def fetch_comments(posts):
+            with self.stats.timer('get_comments'):
+                return posts, self.fetch_comments_batch([ps for ps in posts if 'id' in ps], accountId,
+                                                        batch_size=batchSize, failed_posts=failed_posts)
+
+        def resolve_authors(page):
+            posts, postComments = page
+            self.prefetch_authors(posts + [c for ps, comments in postComments for c in comments], account_dict)
+            return page
+
+        def build_posts(page):
+            posts, postComments = page
+            with self.stats.timer('write_post'):
+                for j in range(len(posts)):
+                    self.write_post(posts, j, account_dict, write_reposts=writeReposts)
+                for ps, comments in postComments:
+                    if ps['id'] not in account_dict['posts']:
+                        continue
+                    for comment in comments:
+                        self.write_comment(comment, account_dict, ps['id'])
+            builtPosts = list(account_dict['posts'].items())
+            account_dict['posts'].clear()
+            return builtPosts
+
+        def write_posts(builtPosts):
+            with self.stats.timer('output'):
+                for postId, post in builtPosts:
+                    account_dict['writer'].write_post(postId, post)
+
+        pipeline = HarvestPipeline([('comments', fetch_comments),
+                                    ('authors', resolve_authors),
+                                    ('build', build_posts),
+                                    ('output', write_posts)],
+                                   queue_size=self.pipeline_queue_size,
+                                   on_start=on_start, on_stop=on_stop)
+        with self.pipelineLock:
+            self.pipelines.append(pipeline)
+        return pipeline
+
+    def close_pipeline(self, pipeline):
+        """
+        Wait until the pipeline has processed everything and stop it.
+        Return False if any of its stages has failed.
+        """
+        success = pipeline.close()
+        with self.pipelineLock:
+            self.pipelines.remove(pipeline)
+        return success
 
-    def get_posts(self, account_dict, is_group=True):
+    def queue_depths(self):
+        """
+        Return the total number of pages waiting in front of each stage
+        of the pipelines that are currently running.
+        """
+        depths = {}
+        with self.pipelineLock:
+            for pipeline in self.pipelines:
+                for name, depth in pipeline.queue_depths().items():
+                    depths[name] = depths.get(name, 0) + depth
+        return depths
+
+    def get_posts(self, account_dict, is_group=True, n_posts=None):
         """
         Get all posts and comments of a single group or user. If is_group
         is True, treat the account as a group, otherwise as a user.
+        If account_dict['state'] describes an earlier harvest, only
+        get the posts that are newer than the newest post downloaded
+        then, and the posts whose number of comments has changed among
+        the self.recheck_depth newest ones downloaded earlier.
+        n_posts is the number of posts on the wall, if it is already known.
+        If self.pipeline is True, only the paging is done in this thread,
+        and everything else in a pipeline (see make_pipeline).
+        Return True if the account has been downloaded, False otherwise.
         """
         offset = 0              # post number offset, in hundreds
-        self.n_batch_calls = 25
+        state = account_dict['state']
+        state.setdefault('comment_counts', {})
+        state.setdefault('newest_id', 0)
+        knownNewestId = state['newest_id']
+        knownCommentCounts = dict(state['comment_counts'])
+        nKnownSeen = 0
+        batchSize = BatchSizeController(max_size=self.n_batch_calls)
         accountId = account_dict['meta']['id']
         writeReposts = False
         if is_group:
             accountId *= -1     # Groups have negative IDs
             writeReposts = True
-        parameters = {'owner_id': accountId, 'count': '0'}
-        wall = self.get_response('https://api.vk.com/method/wall.get', parameters)
-        if 'response' not in wall:
-            print('Something went wrong when trying to download the account', account_dict['meta']['id'],
-                  ':', wall)
-            return
-        nPosts = wall['response']['count']
+        nPosts = n_posts
+        if nPosts is None:
+            parameters = {'owner_id': accountId, 'count': '0'}
+            wall = self.get_response(self.api_url + 'wall.get', parameters)
+            if wall is None or 'response' not in wall:
+                print('Something went wrong when trying to download the account', account_dict['meta']['id'],
+                      ':', wall)
+                return False
+            nPosts = wall['response']['count']
         print(nPosts, 'posts on the wall.')
         offHundreds = nPosts // 100 + 1
-        while offset < offHundreds:
-            print('Getting posts...')
-            command = 'API.wall.get({"owner_id": ' + str(accountId)
-            wall = None
-            while wall is None or 'error' in wall:
-                code = self.execute_code(offset, command, nPosts)
-                wall = self.get_response('https://api.vk.com/method/execute',
-                                         {'code': code, 'access_token': self.access_token})
-                if wall is None or 'error' in wall:
-                    # Each response contains at most 2500 enrties (25 calls, 100 entries each),
-                    # but if that turns out to be too much for vk to process, try reducing
-                    # the number of calls per request.
+        if knownNewestId > 0:
+            # Only the new posts and the self.recheck_depth newest known ones
+            # have to be paged through, so the first request should not ask
+            # for the whole wall. The batch grows if there is more to download.
+            nExpected = max(nPosts - len(knownCommentCounts), 0) + self.recheck_depth
+            batchSize.size = max(batchSize.min_size, min(batchSize.size, nExpected // 100 + 1))
+        postFields = self.post_fields
+        success = True
+        # Posts whose comments could not be downloaded
+        failedPosts = []
+        pipeline = None
+        if self.pipeline:
+            pipeline = self.make_pipeline(account_dict, is_group=is_group, failed_posts=failedPosts)
+        try:
+            while offset < offHundreds:
+                print('Getting posts...')
+                command = 'API.wall.get({"owner_id": ' + str(accountId)
+                nCalls = batchSize.size
+                code = self.execute_code(offset, command, nPosts, fields=postFields, n_calls=nCalls)
+                wall = self.get_response(self.api_url + 'execute', {'code': code})
+                wallPosts = None
+                if wall is not None and 'response' in wall:
+                    wallPosts = self.unpack_items(wall['response'], postFields)
+                    if wallPosts is None and postFields is not None:
+                        # The columns do not match, probably because vk has left out
+                        # the missing values instead of returning null for them.
+                        # This is not the fault of the batch size.
+                        print('Could not unpack the projected posts, downloading complete posts instead.')
+                        postFields = None
+                        continue
+                else:
                     print(wall)
-                    self.n_batch_calls -= 5
-                    if self.n_batch_calls < 5:
-                        print('Could not download account', account_dict['meta']['screen_name'])
-                        return
-            if 'response' in wall and len(wall['response']) > 0:
-                for j in range(len(wall['response'])):
-                    self.write_post(wall['response'], j, account_dict,
-                                    write_reposts=writeReposts, is_group=is_group)
-            offset += self.n_batch_calls
-            time.sleep(0.5)
-
-    def process_group(self, gr, overwrite_downloaded=True):
+                # Each response contains at most 2500 enrties (25 calls, 100 entries each),
+                # but if that turns out to be too much for vk to process, try reducing
+                # the number of calls per request.
+                if not self.report_batch(batchSize, wallPosts):
+                    print('Could not download account', account_dict['meta']['screen_name'])
+                    success = False
+                    break
+                if wallPosts is None:
+                    # Try again at the same offset with fewer calls
+                    continue
+                if len(wallPosts) > 0:
+                    posts = []
+                    for ps in wallPosts:
+                        if 'id' in ps and ps['id'] <= knownNewestId:
+                            # This post has been downloaded before
+                            if 'is_pinned' not in ps or ps['is_pinned'] == 0:
+                                nKnownSeen += 1
+                            if self.comment_count(ps) == knownCommentCounts.get(str(ps['id']), -1):
+                                continue
+                        posts.append(ps)
+                    if pipeline is not None:
+                        if pipeline.failed:
+                            success = False
+                            break
+                        pipeline.put(posts)
+                    else:
+                        self.prefetch_authors(posts, account_dict)
+                        with self.stats.timer('write_post'):
+                            for j in range(len(posts)):
+                                self.write_post(posts, j, account_dict, write_reposts=writeReposts)
+                        with self.stats.timer('get_comments'):
+                            self.get_comments_batch([ps for ps in posts if ps.get('id') in account_dict['posts']],
+                                                    account_dict, is_group=is_group, batch_size=batchSize,
+                                                    failed_posts=failedPosts)
+                        self.flush_posts(account_dict)
+                offset += nCalls
+                if knownNewestId > 0 and nKnownSeen >= self.recheck_depth:
+                    print('Reached the posts downloaded earlier.')
+                    break
+        finally:
+            # The stage threads are stopped even if paging fails with an
+            # exception; otherwise they would wait for more pages forever.
+            if pipeline is not None:
+                success = self.close_pipeline(pipeline) and success
+        if len(failedPosts) > 0:
+            print('Could not download the comments to', len(failedPosts), 'posts of the account',
+                  account_dict['meta']['screen_name'])
+            success = False
+        return success
+
+    def process_group(self, gr, overwrite_downloaded=True, incremental=False, wall_summary=None):
         """
         Download a group and return all posts and comments as a dictionary.
         gr: group metadata
+        If incremental is True and the group has been downloaded before,
+        only download new posts and comments and add them to the existing file.
+        wall_summary: the summary of the wall made by get_wall_summaries, if any
         """
         print('Starting group', gr, '...')
         date_start = datetime.datetime.today()
-        filename = self.lang + '/' + gr['screen_name'] + '.json'
-        if os.path.exists(filename):
+        filename = self.account_filename(gr['screen_name'], is_group=True)
+        state = {}
+        if self.writer_class.recover(filename):
+            print('Removed an unfinished update from', filename)
+        if self.writer_class.is_complete(filename):
             print('File for the group', gr['screen_name'], 'already exists.')
-            if not overwrite_downloaded:
+            if incremental:
+                state = self.load_state(filename)
+            elif not overwrite_downloaded:
                 return
         if gr['is_closed'] == 2:
             print(gr['screen_name'], 'does not exist.')
             return
-        group_dict = {'meta': {}, 'posts': {}}
+        group_dict = {'meta': {}, 'posts': {}, 'writer': None, 'state': state}
         group_dict['meta'] = {'id': gr['id'],
                               'name': gr['name'],
                               'screen_name': gr['screen_name'],
                               'members_count': gr['members_count'],
                               'language': self.lang,
+                              'languages': self.account_languages.get(-gr['id'], [self.lang]),
                               'date': str(datetime.datetime.today())}
         if gr['is_closed'] == 1:
             print(gr['screen_name'], 'is a closed group.')
             return
-        self.get_posts(group_dict, is_group=True)
-        with open(filename, 'w', encoding='utf-8') as groupDump:
-            json.dump(group_dict, groupDump, ensure_ascii=False, indent=2, sort_keys=True)
-        self.save_user_ids()
+        group_dict['writer'] = self.writer_class(filename, append=len(state) > 0)
+        nPosts = None
+        if wall_summary is not None:
+            nPosts = wall_summary['count']
+        success = self.get_posts(group_dict, is_group=True, n_posts=nPosts)
+        with self.stats.timer('output'):
+            group_dict['writer'].close(group_dict['meta'], complete=success)
+            # If the download failed, newest_id in the state may already be
+            # past the pages that were not downloaded, so the old state is kept
+            # and the next incremental harvest starts from it again.
+            if success:
+                self.save_state(filename, state)
+            if success and wall_summary is not None:
+                self.update_manifest(-gr['id'], wall_summary)
+        with self.stats.timer('save_user_data'):
+            self.save_user_ids()
+        self.stats.count('groups')
         print('Group', gr['screen_name'], 'harvested in', str(datetime.datetime.today() - date_start))
+        return success
 
-    def process_user(self, user, overwrite_downloaded=True):
+    def process_user(self, user, overwrite_downloaded=True, incremental=False, wall_summary=None):
         """
         Download the user's wall and return all posts and comments as a dictionary.
         user: user metadata
+        If incremental is True and the wall has been downloaded before,
+        only download new posts and comments and add them to the existing file.
+        wall_summary: the summary of the wall made by get_wall_summaries, if any
         """
         if 'screen_name' not in user:
             if 'deactivated' in user:
@@ -428,51 +2430,376 @@ class VkHarvester:
             return
         print('Starting user', user['screen_name'], '...')
         date_start = datetime.datetime.today()
-        filename = self.lang + '/users/' + user['screen_name'] + '.json'
-        if os.path.exists(filename):
+        filename = self.account_filename(user['screen_name'], is_group=False)
+        state = {}
+        if self.writer_class.recover(filename):
+            print('Removed an unfinished update from', filename)
+        if self.writer_class.is_complete(filename):
             print('File for the user', user['screen_name'], 'already exists.')
-            if not overwrite_downloaded:
+            if incremental:
+                state = self.load_state(filename)
+            elif not overwrite_downloaded:
                 return
-        user_dict = {'meta': copy.deepcopy(user), 'posts': {}}
-        user_dict['meta']['language'] = self.lang,
+        user_dict = {'meta': copy.deepcopy(user), 'posts': {}, 'writer': None, 'state': state}
+        user_dict['meta']['language'] = self.lang
+        user_dict['meta']['languages'] = self.account_languages.get(user['id'], [self.lang])
         user_dict['meta']['date'] = str(datetime.datetime.today())
-        self.get_posts(user_dict, is_group=False)
-        with open(filename, 'w', encoding='utf-8') as userDump:
-            json.dump(user_dict, userDump, ensure_ascii=False, indent=2, sort_keys=True)
-        self.save_user_ids()
+        user_dict['writer'] = self.writer_class(filename, append=len(state) > 0)
+        nPosts = None
+        if wall_summary is not None:
+            nPosts = wall_summary['count']
+        success = self.get_posts(user_dict, is_group=False, n_posts=nPosts)
+        with self.stats.timer('output'):
+            user_dict['writer'].close(user_dict['meta'], complete=success)
+            # If the download failed, newest_id in the state may already be
+            # past the pages that were not downloaded, so the old state is kept
+            # and the next incremental harvest starts from it again.
+            if success:
+                self.save_state(filename, state)
+            if success and wall_summary is not None:
+                self.update_manifest(user['id'], wall_summary)
+        with self.stats.timer('save_user_data'):
+            self.save_user_ids()
+        self.stats.count('users')
         print('User', user['screen_name'], 'harvested in', str(datetime.datetime.today() - date_start))
+        return success
 
-    def harvest(self, overwrite_downloaded=False):
+    def process_with_token(self, process_function, account, **kwargs):
         """
-        Download contents of the groups and the users' walls, using
-        a list of URLs located in %self.lang%_vk_urls.txt. If overwrite_downloaded
-        is False, skip groups and users for which there already exists
-        a JSON file.
+        Take a free access token from the pool, process a group or a user
+        with it and put the token back. Return what process_function returns.
         """
-        print('Harvesting started.')
-        print('Harvesting groups first...')
-        personalUrls = set(url.strip() for url in harvester.urls
+        self.local.access_token = self.tokenPool.get()
+        try:
+            return process_function(account, **kwargs)
+        finally:
+            self.tokenPool.put(self.local.access_token)
+            del self.local.access_token
+
+    def process_url(self, url, overwrite_downloaded=True, incremental=False):
+        """
+        Download a group or a user's wall by its URL from the list.
+        Return False if the account could not be downloaded.
+        """
+        groups = []
+        if not re.search('^id[0-9]+$', url):
+            groups = self.get_groups_extended([url])
+        if len(groups) > 0 and (url.startswith('club') or groups[0]['screen_name'] == url):
+            return self.process_group(groups[0], overwrite_downloaded=overwrite_downloaded,
+                                      incremental=incremental) is not False
+        users = self.get_users([url])
+        if len(users) <= 0:
+            print('Account not found:', url)
+            return True
+        return self.process_user(users[0], overwrite_downloaded=overwrite_downloaded,
+                                 incremental=incremental) is not False
+
+    def make_token_pool(self, n_workers=None):
+        """
+        Put all access tokens into the pool shared by the worker threads
+        and return the number of threads to use (by default, one per token).
+        """
+        accessTokens = self.access_tokens
+        if len(accessTokens) <= 0:
+            accessTokens = [self.access_token]
+        if n_workers is None:
+            n_workers = len(accessTokens)
+        n_workers = max(1, min(n_workers, len(accessTokens)))
+        self.tokenPool = queue.Queue()
+        for accessToken in accessTokens:
+            self.tokenPool.put(accessToken)
+        return n_workers
+
+    def harvest_queue(self, work_queue, overwrite_downloaded=False, n_workers=None, incremental=False):
+        """
+        Harvest the accounts from the list together with other processes,
+        possibly on other machines, that share the work_queue (a WorkQueue).
+        Each account is leased from the queue, so that it is only downloaded
+        by one process. Adding the list to the queue again does not change
+        anything, so all processes may call this function with the same list.
+        Each process should keep its user data in a separate metadata store,
+        and its reposted texts in a separate RepostStore; the stores can be
+        merged afterwards (see SqliteMetadataStore.merge and RepostStore.merge).
+        """
+        print('Harvesting started as', work_queue.worker_id)
+        work_queue.add(self.lang, self.urls)
+        n_workers = self.make_token_pool(n_workers)
+        work_queue.start_heartbeat()
+
+        def work():
+            while True:
+                url = work_queue.lease(self.lang)
+                if url is None:
+                    return
+                try:
+                    success = self.process_with_token(self.process_url, url,
+                                                      overwrite_downloaded=overwrite_downloaded,
+                                                      incremental=incremental)
+                except Exception:
+                    print('Error when harvesting', url, ':')
+                    traceback.print_exc()
+                    success = False
+                work_queue.finish(self.lang, url, success=success)
+
+        try:
+            with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                tasks = [executor.submit(work) for i in range(n_workers)]
+                for task in tasks:
+                    task.result()
+        finally:
+            work_queue.stop_heartbeat()
+        print('Harvesting finished:', work_queue.counts(self.lang))
+
+    def plan_harvest(self, groups, users, incremental=False):
+        """
+        Check all walls with get_wall_summaries and return a list
+        of (process function, account, wall summary) tuples, ordered
+        by the estimated number of posts to download, largest first.
+        If incremental is True, leave out the accounts whose files are
+        complete and whose walls have not changed (neither the number
+        of posts nor the newest post) since they were last harvested.
+        New comments to old posts of such walls are only downloaded
+        the next time the wall changes.
+        """
+        self.load_manifest()
+        accounts = [(self.process_group, gr, -gr['id'], gr.get('screen_name'), True)
+                    for gr in groups if gr.get('is_closed') == 0]
+        accounts += [(self.process_user, user, user['id'], user.get('screen_name'), False)
+                     for user in users if 'id' in user and 'deactivated' not in user]
+        summaries = self.get_wall_summaries([account[2] for account in accounts])
+        print('Checked', len(summaries), 'walls out of', len(accounts), 'in the pre-pass.')
+        plan = []
+        nUnchanged = 0
+        for process_function, account, ownerId, screenName, isGroup in accounts:
+            summary = summaries.get(ownerId)
+            work = 0
+            if summary is not None:
+                work = summary['count']
+                known = self.manifest.get(str(ownerId))
+                if incremental and known is not None:
+                    if (known['count'] == summary['count'] and known['newest_id'] == summary['newest_id']
+                            and screenName is not None
+                            and self.writer_class.is_complete(self.account_filename(screenName, isGroup))):
+                        nUnchanged += 1
+                        continue
+                    work = max(summary['count'] - known['count'], 1)
+            plan.append((process_function, account, summary, work))
+        print(nUnchanged, 'walls have not changed since the last harvest.')
+        plan.sort(key=lambda item: -item[3])
+        # Closed groups and deactivated users are passed on unchecked,
+        # process_group and process_user will report them.
+        plan += [(self.process_group, gr, None, 0) for gr in groups if gr.get('is_closed') != 0]
+        plan += [(self.process_user, user, None, 0) for user in users
+                 if 'id' not in user or 'deactivated' in user]
+        return [item[:3] for item in plan]
+
+    def get_accounts(self, urls):
+        """
+        Retrieve the data of the groups and users in the URL list.
+        Return the list of groups and the list of users.
+        """
+        personalUrls = set(url.strip() for url in urls
                            if not url.startswith('club'))
-        groups = harvester.get_groups_extended(harvester.urls)
+        groups = self.get_groups_extended(urls)
         for i in range(len(groups)):
             if groups[i]['screen_name'] in personalUrls:
                 personalUrls.remove(groups[i]['screen_name'])
-            harvester.process_group(groups[i], overwrite_downloaded=overwrite_downloaded)
-        print('Group harvesting finished.')
-        print('Harvesting users...')
         personalUrls = list(personalUrls)
         print('Personal URLs:', ','.join(personalUrls))
         users = self.get_users(personalUrls)
-        for i in range(len(users)):
-            harvester.process_user(users[i], overwrite_downloaded=overwrite_downloaded)
+        return groups, users
+
+    def make_plan(self, groups, users, incremental=False, prepass=True):
+        """
+        Return the list of (process function, account, wall summary)
+        tuples to harvest, using plan_harvest if prepass is True.
+        """
+        if prepass:
+            return self.plan_harvest(groups, users, incremental=incremental)
+        plan = [(self.process_group, gr, None) for gr in groups]
+        plan += [(self.process_user, user, None) for user in users]
+        return plan
+
+    def harvest(self, overwrite_downloaded=False, n_workers=None, incremental=False, prepass=True):
+        """
+        Download contents of the groups and the users' walls, using
+        a list of URLs located in %self.lang%_vk_urls.txt. If overwrite_downloaded
+        is False, skip groups and users for which there already exists
+        a JSON file. If incremental is True, update such files with
+        the posts and comments that have appeared since they were
+        downloaded. The accounts are distributed over n_workers threads
+        (by default, one per access token). Each thread takes a token from
+        the pool, so that no token is used by two threads at once.
+        If prepass is True, all walls are checked first with a few
+        execute requests, and only the changed ones are harvested
+        (see plan_harvest).
+        """
+        print('Harvesting started.')
+        groups, users = self.get_accounts(self.urls)
+        n_workers = self.make_token_pool(n_workers)
+        plan = self.make_plan(groups, users, incremental=incremental, prepass=prepass)
+        print('Harvesting', len(plan), 'of', len(groups), 'groups and', len(users), 'users in',
+              n_workers, 'threads...')
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            tasks = [executor.submit(self.process_with_token, process_function, account,
+                                     overwrite_downloaded=overwrite_downloaded, incremental=incremental,
+                                     wall_summary=summary)
+                     for process_function, account, summary in plan]
+            for task in tasks:
+                try:
+                    task.result()
+                except Exception:
+                    print('Error when harvesting an account:')
+                    traceback.print_exc()
+        print('Harvesting finished.')
+
+
+class MultiLanguageHarvester:
+    """
+    Harvest the URL lists of several languages (%lang%_vk_urls.txt
+    for each lang in langs) together. There is one VkHarvester for each
+    language, but they share the user data, the access tokens with their
+    rate limits, and the statistics, and their accounts are harvested
+    by the same threads. An account that appears in several lists is
+    downloaded once, to the directory of the first of its languages in
+    langs, and all its languages are listed in the languages field of
+    its metadata.
+    """
+    def __init__(self, langs, output_format='json', metadata_store=None, repost_store=None):
+        self.langs = list(langs)
+        if metadata_store is None:
+            metadata_store = JsonMetadataStore()
+        self.metadataStore = metadata_store
+        self.harvesters = collections.OrderedDict()
+        for lang in self.langs:
+            harvester = VkHarvester(lang, output_format=output_format,
+                                    metadata_store=metadata_store, repost_store=repost_store)
+            if len(self.harvesters) > 0:
+                first = self.harvesters[self.langs[0]]
+                harvester.rate_limiters = first.rate_limiters
+                harvester.http_sessions = first.http_sessions
+                harvester.tokenLock = first.tokenLock
+                harvester.missingAuthors = first.missingAuthors
+                harvester.stats = first.stats
+            self.harvesters[lang] = harvester
+        self.stats = self.harvesters[self.langs[0]].stats
+
+    def make_dir(self):
+        for harvester in self.harvesters.values():
+            harvester.make_dir()
+
+    def url_languages(self):
+        """
+        Return a dictionary {URL: list of languages whose lists contain it}.
+        """
+        urlLanguages = {}
+        for lang in self.langs:
+            for url in self.harvesters[lang].urls:
+                urlLanguages.setdefault(url, [])
+                if lang not in urlLanguages[url]:
+                    urlLanguages[url].append(lang)
+        return urlLanguages
+
+    def assign_accounts(self, groups, users, url_languages):
+        """
+        Distribute the groups and users over the harvesters of their
+        first languages, leaving out duplicates. Return a dictionary
+        {lang: (groups, users)}.
+        """
+        accounts = collections.OrderedDict((lang, ([], [])) for lang in self.langs)
+        seen = set()
+        for isGroup, accountList in ((True, groups), (False, users)):
+            for account in accountList:
+                if 'id' not in account:
+                    continue
+                ownerId = account['id']
+                urls = ['id' + str(account['id'])]
+                if isGroup:
+                    ownerId *= -1
+                    urls = ['club' + str(account['id'])]
+                if 'screen_name' in account:
+                    urls.append(account['screen_name'])
+                if ownerId in seen:
+                    continue
+                seen.add(ownerId)
+                langs = [lang for lang in self.langs
+                         if any(lang in url_languages.get(url, []) for url in urls)]
+                if len(langs) <= 0:
+                    langs = [self.langs[0]]
+                harvester = self.harvesters[langs[0]]
+                harvester.account_languages[ownerId] = langs
+                accounts[langs[0]][0 if isGroup else 1].append(account)
+        return accounts
+
+    def harvest(self, overwrite_downloaded=False, n_workers=None, incremental=False, prepass=True):
+        """
+        Harvest the accounts of all languages. The parameters have
+        the same meaning as in VkHarvester.harvest().
+        """
+        print('Harvesting started:', ', '.join(self.langs))
+        first = self.harvesters[self.langs[0]]
+        urlLanguages = self.url_languages()
+        groups, users = first.get_accounts(sorted(urlLanguages))
+        accounts = self.assign_accounts(groups, users, urlLanguages)
+        n_workers = first.make_token_pool(n_workers)
+        plan = []
+        for lang, harvester in self.harvesters.items():
+            harvester.tokenPool = first.tokenPool
+            langGroups, langUsers = accounts[lang]
+            print(lang + ':', len(langGroups), 'groups and', len(langUsers), 'users.')
+            plan += [(harvester, process_function, account, summary)
+                     for process_function, account, summary
+                     in harvester.make_plan(langGroups, langUsers, incremental=incremental, prepass=prepass)]
+        print('Harvesting', len(plan), 'accounts in', n_workers, 'threads...')
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            tasks = [executor.submit(harvester.process_with_token, process_function, account,
+                                     overwrite_downloaded=overwrite_downloaded, incremental=incremental,
+                                     wall_summary=summary)
+                     for harvester, process_function, account, summary in plan]
+            for task in tasks:
+                try:
+                    task.result()
+                except Exception:
+                    print('Error when harvesting an account:')
+                    traceback.print_exc()
         print('Harvesting finished.')
 
+    def save_user_ids(self, fname_mentions=None, fname_userdata=None):
+        self.harvesters[self.langs[0]].save_user_ids(fname_mentions, fname_userdata)
+
 
 if __name__ == '__main__':
     date_start = datetime.datetime.today()
-    harvester = VkHarvester('mhr')
+    # How the harvester keeps its data:
+    # 'json': user data in userData.json and userMentions.json,
+    # 'sqlite': user data in userData.sqlite (import the JSON files once, see below),
+    # 'reposts': in addition, each reposted text is stored only once, in reposts.jsonl,
+    # 'queue': share the list with other machines through a database on a shared disk,
+    # 'multi': harvest several languages at once, sharing the user data.
+    # Only the chosen store is loaded.
+    setup = 'json'
+    if setup == 'sqlite':
+        store = SqliteMetadataStore('userData.sqlite')
+        # store.import_json('userMentions.json', 'userData.json')
+        harvester = VkHarvester('mhr', metadata_store=store)
+    elif setup == 'reposts':
+        harvester = VkHarvester('mhr', repost_store=RepostStore('reposts.jsonl'))
+    elif setup == 'queue':
+        store = SqliteMetadataStore('userData.' + socket.gethostname() + '.sqlite')
+        harvester = VkHarvester('mhr', metadata_store=store,
+                                repost_store=RepostStore('reposts.' + socket.gethostname() + '.jsonl'))
+    elif setup == 'multi':
+        harvester = MultiLanguageHarvester(['mhr', 'mrj', 'udm'])
+    else:
+        harvester = VkHarvester('mhr')
     harvester.make_dir()
-    harvester.harvest()
+    # Write the metrics of the harvest to a file every minute:
+    # harvester.stats.start_export('metrics.jsonl', interval=60)
+    if setup == 'queue':
+        harvester.harvest_queue(WorkQueue('/mnt/shared/workQueue.sqlite'))
+    else:
+        harvester.harvest()
+    # harvester.stats.stop_export()
     # harvester.enhance_user_data()
     # harvester.save_user_ids()
     print('Elapsed time:', str(datetime.datetime.today() - date_start))